@@ -0,0 +1,101 @@
+# Compares the attribute clustering modes of percy.clusters.per_similarity.
+#
+#   python -m benchmarks.clustering [n_regions ...] [--regions regions.csv]
+#
+# Every fit runs in its own process so its peak RSS can be measured.
+import json
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from os import path
+
+import numpy as np
+import pandas as pd
+from sklearn.metrics import adjusted_rand_score
+
+from percy.clusters import per_similarity
+
+MODES = ['agglomerative', 'connectivity']
+# the full linkage needs n² / 2 distances
+MAX_EXACT_REGIONS = 20000
+
+
+def get_attributes(n_regions, regions_file=None, seed=0):
+    if regions_file is not None:
+        df = pd.read_csv(regions_file, usecols=['population', 'area_km']).dropna()
+        return df.sample(n_regions, replace=n_regions > len(df), random_state=seed).reset_index(drop=True)
+
+    # populations and areas of regions are roughly log-normal
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'population': np.round(rng.lognormal(9.5, 1.6, n_regions)),
+        'area_km': rng.lognormal(6.5, 1.5, n_regions),
+    })
+
+
+def get_peak_rss():
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run(mode, n_regions, regions_file, labels_file):
+    df = get_attributes(n_regions, regions_file)
+    rss = get_peak_rss()
+    start = time.perf_counter()
+    labels = per_similarity(df, mode).labels_
+    seconds = time.perf_counter() - start
+    np.save(labels_file, labels)
+    print(json.dumps({
+        'seconds': seconds,
+        'peak_rss': get_peak_rss(),
+        'peak_rss_delta': get_peak_rss() - rss,
+        'clusters': int(len(np.unique(labels))),
+    }))
+
+
+def measure(mode, n_regions, regions_file, directory):
+    labels_file = path.join(directory, f'{mode}-{n_regions}.npy')
+    args = [sys.executable, '-m', 'benchmarks.clustering', '--run', mode, str(n_regions), labels_file]
+    if regions_file is not None:
+        args += ['--regions', regions_file]
+    result = subprocess.run(args, stdout=subprocess.PIPE, check=True, universal_newlines=True)
+    return json.loads(result.stdout.strip().splitlines()[-1]), np.load(labels_file)
+
+
+def main(sizes, regions_file=None):
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for n_regions in sizes:
+            exact = None
+            for mode in MODES:
+                if mode == 'agglomerative' and n_regions > MAX_EXACT_REGIONS:
+                    continue
+
+                result, labels = measure(mode, n_regions, regions_file, directory)
+                if mode == 'agglomerative':
+                    exact = labels
+                result.update({
+                    'mode': mode,
+                    'regions': n_regions,
+                    'adjusted_rand_score': None if exact is None else adjusted_rand_score(exact, labels),
+                })
+                print(f'{n_regions:>7} {mode:<14} {result["seconds"]:>8.2f}s {result["peak_rss_delta"] / 2 ** 20:>9.1f} MiB'
+                      f' {result["clusters"]:>6} clusters  ARI {result["adjusted_rand_score"]}', file=sys.stderr)
+                results.append(result)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    regions_file = None
+    if '--regions' in args:
+        i = args.index('--regions')
+        regions_file = args[i + 1]
+        del args[i:i + 2]
+
+    if args and args[0] == '--run':
+        run(args[1], int(args[2]), regions_file, args[3])
+    else:
+        main([int(n) for n in args] or [1000, 5000, 10000], regions_file)
@@ -0,0 +1,303 @@
+# Times the percy pipeline on synthetic data, offline.
+#
+#   python -m benchmarks.run [n_regions ...] [--output results.json]
+#       [--only name,...] [--max-pairs-regions N] [--data directory]
+#
+# Every benchmark runs in its own process against a generated tree and
+# reports its wall time and peak RSS; the results are written as JSON so
+# runs of different versions can be compared.
+import json
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from os import environ, makedirs, path, symlink
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.synthetic import RAW, generate
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+BENCHMARKS = [
+    'process',
+    'per_similarity',
+    'normalize_timeline',
+    'get_timeline',
+    'get_distance',
+    'per_single_timeline',
+    'per_timeline',
+    'get_distances_batch',
+    'get_distances_batch_dtw',
+    'top_k',
+    'top_k_dtw',
+    'per_timeline_blocks',
+    'per_timeline_blocks_dtw',
+]
+# benchmarks ending with one of these run with that metric
+METRIC_SUFFIXES = {'_dtw': 'dtw'}
+# per_timeline compares every pair of regions in one process
+MAX_PAIRS_REGIONS = 3000
+SAMPLE_SIZE = 200
+DISTANCE_SAMPLE_SIZE = 20000
+
+
+def get_peak_rss():
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def load_metadata():
+    with open(path.join('inf-covid19-data', 'data', 'metadata.json')) as f:
+        return json.load(f)
+
+
+def prepare():
+    from percy.clusters import process, per_similarity
+
+    df = process(load_metadata())
+    df['cluster'] = per_similarity(df).labels_
+    df.sort_values(by=['cluster', 'key']).to_pickle('regions.pkl')
+
+
+def sample_keys(df, count=SAMPLE_SIZE):
+    keys = df['key'].tolist()
+    return random.Random(0).sample(keys, min(count, len(keys)))
+
+
+# Each benchmark does its setup and returns the timed function with the
+# number of operations it performs.
+def bench_process(metadata, df):
+    from percy.clusters import process
+    return lambda: process(metadata), len(df)
+
+
+def bench_per_similarity(metadata, df):
+    from percy.clusters import per_similarity
+    return lambda: per_similarity(df), len(df)
+
+
+def bench_normalize_timeline(metadata, df):
+    from fnc.mappings import get
+    from percy.common import get_key_path, normalize_timeline
+
+    sources = {}
+    regions = []
+    for key in sample_keys(df):
+        region_data = get(get_key_path(key), metadata)
+        filename = region_data['file']
+        if filename not in sources:
+            sources[filename] = pd.read_csv(path.join('inf-covid19-data', filename))
+        regions.append((key, sources[filename], region_data))
+
+    def run():
+        for key, source_df, region_data in regions:
+            normalize_timeline(key, source_df, region_data)
+    return run, len(regions)
+
+
+def bench_get_timeline(metadata, df):
+    from percy.clusters import get_timeline
+    rows = df.to_dict('records')
+
+    def run():
+        for row in rows:
+            get_timeline(metadata, row)
+    return run, len(rows)
+
+
+def bench_get_distance(metadata, df):
+    from percy.clusters import DISTANCE_FEATURES, get_distance, load_timelines, normalize_timelines, timeline_store
+
+    load_timelines(metadata, df)
+    keys = [key for key in df['key'] if timeline_store.length(key) > 0]
+    rng = random.Random(0)
+    windows = []
+    for _ in range(DISTANCE_SAMPLE_SIZE):
+        A, B = normalize_timelines(timeline_store.view(rng.choice(keys)), timeline_store.view(rng.choice(keys)))
+        windows.append((A, B))
+
+    def run():
+        for A, B in windows:
+            for feature in DISTANCE_FEATURES:
+                get_distance(A, B, [feature])
+    return run, len(windows) * len(DISTANCE_FEATURES)
+
+
+def bench_per_single_timeline(metadata, df):
+    from percy.clusters import load_timelines, per_single_timeline
+
+    load_timelines(metadata, df)
+    keys = sample_keys(df, 20)
+
+    def run():
+        for key in keys:
+            per_single_timeline(metadata, key, df)
+    return run, len(keys)
+
+
+def bench_get_distances_batch(metadata, df, metric='manhattan'):
+    from percy.clusters import get_distances_batch, load_timelines, should_get_distances_batch, timeline_store
+
+    load_timelines(metadata, df)
+    rows = timeline_store.rows(df['key'].tolist())
+    batches = []
+    for key in sample_keys(df, 20):
+        a_rows = np.full(len(rows), timeline_store.row(key))
+        eligible = should_get_distances_batch(timeline_store.lengths[a_rows], timeline_store.lengths[rows])
+        batches.append((a_rows[eligible], rows[eligible]))
+
+    def run():
+        for a_rows, b_rows in batches:
+            get_distances_batch(timeline_store, a_rows, b_rows, metric=metric)
+    return run, sum(len(a_rows) for a_rows, _ in batches)
+
+
+def bench_top_k(metadata, df, metric='manhattan'):
+    from percy.clusters import TOP_K, load_timelines, per_single_timeline
+
+    load_timelines(metadata, df)
+    keys = sample_keys(df, 20)
+
+    def run():
+        for key in keys:
+            per_single_timeline(metadata, key, df, top_k=TOP_K, metric=metric)
+    return run, len(keys)
+
+
+def bench_per_timeline_blocks(metadata, df, metric='manhattan'):
+    from percy.pairs import iter_block_results
+
+    def run():
+        for _ in iter_block_results(metadata, df, metric=metric):
+            pass
+    return run, len(df) * (len(df) - 1) // 2
+
+
+def bench_per_timeline(metadata, df):
+    from percy.clusters import load_timelines, per_timeline
+
+    load_timelines(metadata, df)
+
+    def run():
+        # per_timeline handles 500 regions per call
+        for offset in range(0, len(df), 500):
+            per_timeline(metadata, df, offset)
+    return run, len(df) * (len(df) - 1) // 2
+
+
+def run(name):
+    from percy.metrics import metrics
+
+    metadata = load_metadata()
+    df = pd.read_pickle('regions.pkl')
+    kwargs = {}
+    for suffix, metric in METRIC_SUFFIXES.items():
+        if name.endswith(suffix):
+            name, kwargs = name[:-len(suffix)], {'metric': metric}
+    fn, operations = globals()[f'bench_{name}'](metadata, df, **kwargs)
+
+    metrics.drain()
+    rss = get_peak_rss()
+    start = time.perf_counter()
+    fn()
+    seconds = time.perf_counter() - start
+    counters = {counter: value for (counter, _), value in metrics.drain()['counters'].items()}
+
+    return {
+        'seconds': seconds,
+        'operations': operations,
+        'peak_rss': get_peak_rss(),
+        'peak_rss_delta': get_peak_rss() - rss,
+        'pairs_evaluated': counters.get('percy_pairs_evaluated_total'),
+        'pairs_pruned': counters.get('percy_pairs_pruned_total'),
+    }
+
+
+def run_isolated(args, directory):
+    # per_timeline prints its progress, the result is the last line
+    env = dict(environ, PYTHONPATH=ROOT)
+    result = subprocess.run([sys.executable, '-m', 'benchmarks.run'] + args, cwd=directory, env=env,
+        stdout=subprocess.PIPE, check=True, universal_newlines=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def get_commit():
+    try:
+        return subprocess.run(['git', '-C', ROOT, 'rev-parse', 'HEAD'], stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL, check=True, universal_newlines=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def benchmark(n_regions, directory, names, max_pairs_regions):
+    if not path.isdir(path.join(directory, 'inf-covid19-data')):
+        generate(path.join(directory, 'inf-covid19-data'), n_regions)
+    if not path.exists(path.join(directory, 'raw')):
+        symlink(RAW, path.join(directory, 'raw'))
+
+    run_isolated(['--prepare'], directory)
+    regions = len(pd.read_pickle(path.join(directory, 'regions.pkl')))
+
+    results = []
+    for name in names:
+        if name == 'per_timeline' and regions > max_pairs_regions:
+            print(f'{regions:>7} {name:<20} skipped', file=sys.stderr)
+            continue
+
+        result = run_isolated(['--run', name], directory)
+        result.update({'benchmark': name, 'regions': regions})
+        print(f'{regions:>7} {name:<20} {result["seconds"]:>9.3f}s {result["peak_rss_delta"] / 2 ** 20:>9.1f} MiB',
+              file=sys.stderr)
+        results.append(result)
+    return results
+
+
+def main(sizes, output, names, max_pairs_regions, data=None):
+    results = []
+    for n_regions in sizes:
+        if data is not None:
+            directory = path.join(data, str(n_regions))
+            makedirs(directory, exist_ok=True)
+            results += benchmark(n_regions, directory, names, max_pairs_regions)
+        else:
+            with tempfile.TemporaryDirectory(prefix='percy-benchmark-') as directory:
+                results += benchmark(n_regions, directory, names, max_pairs_regions)
+
+    report = {
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+def pop_option(args, name, default=None):
+    if name not in args:
+        return default
+    i = args.index(name)
+    value = args[i + 1]
+    del args[i:i + 2]
+    return value
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if args and args[0] == '--prepare':
+        prepare()
+        print('{}')
+    elif args and args[0] == '--run':
+        print(json.dumps(run(args[1])))
+    else:
+        output = pop_option(args, '--output', 'benchmark-results.json')
+        names = pop_option(args, '--only')
+        names = BENCHMARKS if names is None else names.split(',')
+        max_pairs_regions = int(pop_option(args, '--max-pairs-regions', MAX_PAIRS_REGIONS))
+        data = pop_option(args, '--data')
+        main([int(n) for n in args] or [100, 1000, 5000], output, names, max_pairs_regions, data)
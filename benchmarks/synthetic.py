@@ -0,0 +1,200 @@
+# Writes a synthetic inf-covid19-data tree: metadata.json, ECDC-style
+# country files and Brazil/USA-style state files, using the region codes
+# in raw/ so every region gets an area and a population.
+#
+#   python -m benchmarks.synthetic <directory> [n_regions] [--seed N]
+import json
+import sys
+from os import makedirs, path
+
+import numpy as np
+import pandas as pd
+
+RAW = path.join(path.dirname(path.dirname(path.abspath(__file__))), 'raw')
+END_DATE = pd.Timestamp('2020-08-01')
+MAX_COUNTRIES = 200
+# share of missing days in every file
+MISSING_DAYS = 0.05
+DATE_STRINGS = pd.date_range(end=END_DATE, periods=200).strftime('%Y-%m-%d').to_numpy(dtype=object)
+
+
+def get_region_counts(n_regions):
+    countries = min(MAX_COUNTRIES, max(2, n_regions // 50))
+    subregions = max(n_regions - countries, 0)
+    cities = subregions * 3 // 5
+    return countries, cities, subregions - cities
+
+
+def get_curve(rng, days):
+    # cumulative cases and deaths following a logistic-like growth
+    growth = rng.uniform(0.03, 0.2)
+    scale = rng.uniform(10, 5000)
+    t = np.arange(days)
+    cases = np.floor(scale * (np.exp(growth * t) - 1) / (1 + np.exp(growth * (t - days / 2))) + 1)
+    cases = np.maximum.accumulate(cases).astype(np.int64)
+    deaths = np.floor(cases * rng.uniform(0.005, 0.05)).astype(np.int64)
+    return cases, deaths
+
+
+def get_dates(rng, min_days, max_days):
+    dates = pd.date_range(end=END_DATE, periods=int(rng.integers(min_days, max_days)))
+    return dates, rng.random(len(dates)) >= MISSING_DAYS
+
+
+def get_date_strings(count):
+    # the last `count` dates up to END_DATE, formatted once
+    if count > len(DATE_STRINGS):
+        return pd.date_range(end=END_DATE, periods=count).strftime('%Y-%m-%d').to_numpy(dtype=object)
+    return DATE_STRINGS[len(DATE_STRINGS) - count:]
+
+
+def sample(df, count, rng):
+    # beyond the real codes, regions are repeated under new names
+    rows = rng.permutation(len(df))
+    if count > len(df):
+        rows = np.concatenate([rows, rng.integers(0, len(df), count - len(df))])
+    return df.iloc[rows[:count]].reset_index(drop=True)
+
+
+def get_unique_names(names):
+    seen = {}
+    unique_names = []
+    for name in names:
+        seen[name] = seen.get(name, 0) + 1
+        unique_names.append(name if seen[name] == 1 else f'{name} {seen[name]}')
+    return unique_names
+
+
+def write_country(out, rng, name, code, population):
+    dates, kept = get_dates(rng, 20, 200)
+    cases, deaths = get_curve(rng, len(dates))
+    df = pd.DataFrame({
+        'dateRep': dates.strftime('%Y-%m-%d'),
+        'day': dates.day,
+        'month': dates.month,
+        'year': dates.year,
+        'cases': np.diff(cases, prepend=0),
+        'deaths': np.diff(deaths, prepend=0),
+        'countriesAndTerritories': name,
+        'geoId': code[:2],
+        'countryterritoryCode': code,
+        'popData2019': population,
+    })[kept].iloc[::-1]
+
+    filename = f'data/countries/{name}.csv'
+    df.to_csv(path.join(out, filename), index=False)
+    return {'countryTerritoryCode': code, 'file': filename, 'regions': {}}
+
+
+def get_region_rows(rng, columns):
+    # one row per known day of a region, with cumulative counts
+    days = int(rng.integers(5, 150))
+    kept = rng.random(days) >= MISSING_DAYS
+    cases, deaths = get_curve(rng, days)
+    rows = {'date': get_date_strings(days)[kept], 'cases': cases[kept], 'deaths': deaths[kept]}
+    for column, value in columns.items():
+        rows[column] = np.full(kept.sum(), value, dtype=object)
+    return rows
+
+
+def get_frame(rows):
+    return pd.DataFrame({column: np.concatenate([region[column] for region in rows]) for column in rows[0]})
+
+
+def write_brazil(out, rng, count, metadata):
+    cities = pd.read_csv(path.join(RAW, 'brazil', 'area_by_city.csv'))
+    states = pd.read_csv(path.join(RAW, 'brazil', 'area_by_state.csv')).set_index('NM_UF_SIGLA')
+
+    cities = sample(cities, count, rng)
+    cities['name'] = get_unique_names(cities['NM_MUN_2018'])
+
+    brazil = metadata['Brazil']
+    for uf, group in cities.groupby('NM_UF_SIGLA'):
+        filename = f'data/brazil/{uf}.csv'
+        state_key = f'{uf.lower()}_state'
+        brazil['regions'][state_key] = {'name': uf, 'place_type': 'state', 'file': filename}
+
+        frames = [get_region_rows(rng, {
+            'state': uf, 'city': None, 'place_type': 'state',
+            'estimated_population_2019': int(rng.integers(10 ** 5, 10 ** 7)),
+            'city_ibge_code': states.loc[uf, 'CD_GCUF'],
+        })]
+        for i, city in enumerate(group.itertuples()):
+            frames.append(get_region_rows(rng, {
+                'state': uf, 'city': city.name, 'place_type': 'city',
+                'estimated_population_2019': int(rng.integers(10 ** 3, 10 ** 7)),
+                'city_ibge_code': city.CD_GCMUN,
+            }))
+            brazil['regions'][f'{uf.lower()}_{city.CD_GCMUN}_{i}'] = {
+                'name': city.name, 'place_type': 'city', 'file': filename, 'parent': state_key,
+            }
+
+        df = get_frame(frames).rename(columns={'cases': 'confirmed'})
+        df = df[['date', 'state', 'city', 'place_type', 'confirmed', 'deaths', 'estimated_population_2019', 'city_ibge_code']]
+        df.sort_values('date', ascending=False, kind='mergesort').to_csv(path.join(out, filename), index=False)
+
+
+def write_usa(out, rng, count, metadata):
+    counties = pd.read_csv(path.join(RAW, 'united_states_of_america', 'co-est2019-alldata.csv'), encoding='ISO-8859-1',
+        usecols=['STATE', 'COUNTY', 'STNAME', 'CTYNAME'])
+    counties = sample(counties[counties['COUNTY'] != 0], count, rng)
+    counties['name'] = get_unique_names(counties['CTYNAME'])
+
+    usa = metadata['United_States_of_America']
+    for state, group in counties.groupby('STNAME'):
+        slug = state.lower().replace(' ', '_')
+        filename = f'data/usa/{slug}.csv'
+        state_key = f'{slug}_state'
+        state_fips = int(group['STATE'].iloc[0])
+        usa['regions'][state_key] = {'name': state, 'place_type': 'state', 'file': filename}
+
+        frames = [get_region_rows(rng, {'county': None, 'state': state, 'fips': state_fips, 'place_type': 'state'})]
+        for i, county in enumerate(group.itertuples()):
+            fips = state_fips * 1000 + int(county.COUNTY)
+            frames.append(get_region_rows(rng, {'county': county.name, 'state': state, 'fips': fips, 'place_type': 'county'}))
+            usa['regions'][f'{slug}_{fips}_{i}'] = {
+                'name': county.name, 'place_type': 'county', 'file': filename, 'parent': state_key,
+            }
+
+        df = get_frame(frames)
+        df = df[['date', 'county', 'state', 'fips', 'cases', 'deaths', 'place_type']]
+        df.to_csv(path.join(out, filename), index=False)
+
+
+def generate(out, n_regions, seed=0):
+    rng = np.random.default_rng(seed)
+    for directory in ['countries', 'brazil', 'usa']:
+        makedirs(path.join(out, 'data', directory), exist_ok=True)
+
+    n_countries, n_cities, n_counties = get_region_counts(n_regions)
+
+    codes = pd.read_csv(path.join(RAW, 'area_by_country.csv'))['Country Code']
+    codes = codes[~codes.isin(['BRA', 'USA'])].tolist()
+
+    metadata = {}
+    for i in range(n_countries):
+        name = f'Country_{i}'
+        metadata[name] = write_country(out, rng, name, codes[i % len(codes)], int(rng.integers(10 ** 5, 10 ** 8)))
+    metadata['Brazil'] = write_country(out, rng, 'Brazil', 'BRA', 211049527)
+    metadata['United_States_of_America'] = write_country(out, rng, 'United_States_of_America', 'USA', 329064917)
+
+    write_brazil(out, rng, n_cities, metadata)
+    write_usa(out, rng, n_counties, metadata)
+
+    with open(path.join(out, 'data', 'metadata.json'), 'w') as f:
+        json.dump(metadata, f)
+
+    return metadata
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    seed = 0
+    if '--seed' in args:
+        i = args.index('--seed')
+        seed = int(args[i + 1])
+        del args[i:i + 2]
+
+    metadata = generate(args[0], int(args[1]) if len(args) > 1 else 1000, seed)
+    count = sum(1 + len(data['regions']) for data in metadata.values())
+    print(f'{count} regions written to {args[0]}', file=sys.stderr)
@@ -5,20 +5,16 @@ from os import path
 import time
 from sultan.api import Sultan
 
-
-def get_latest_commit_date(region):
-    try:
-        with Sultan.load(env={'PAGER': 'cat'}) as s:
-            result = s.git(f'-C inf-covid19-similarity-data log -1 --format=%ct "by_key/{region}.csv"').run()
-            return int(''.join(result.stdout).strip())
-    except:
-        return 0
+from percy.freshness import FreshnessIndex
 
 
 with Sultan.load() as s:
     s.git('-C inf-covid19-data pull origin master').run()
     s.git('-C inf-covid19-similarity-data pull origin master').run()
 
+freshness = FreshnessIndex('inf-covid19-similarity-data')
+freshness.build()
+
 df = pd.read_csv('inf-covid19-similarity-data/regions.csv')
 
 df = df.sort_values('population', ascending=False)
@@ -27,7 +23,7 @@ print("Requesting update...")
 for key in df['key']:
     print(f"  {key}")
 
-    is_up_to_date = time.time() - get_latest_commit_date(key) < 60 * 60 * 24
+    is_up_to_date = freshness.is_up_to_date(f'by_key/{key}.csv')
     if not is_up_to_date:
         region = urllib.parse.quote(key)
         urllib.request.urlretrieve(f'http://localhost:8000/api/v1/regions/{region}', f'./tmp/{key}.csv')
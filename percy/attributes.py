@@ -0,0 +1,37 @@
+from os import getenv
+import logging
+import multiprocessing
+import time
+
+import pandas as pd
+
+
+def get_attribute_processes():
+    return int(getenv('SIMILARITY_ATTRIBUTE_PROCESSES', multiprocessing.cpu_count()))
+
+
+def process_source(task):
+    index, process_fn, key, metadata = task
+    start = time.perf_counter()
+    attributes = process_fn(key, metadata)
+    return index, attributes, time.perf_counter() - start
+
+
+def process_sources(tasks, processes=None):
+    # Runs every (process_fn, key, metadata) task and returns the attribute
+    # frames in the order of `tasks`, with the time each one took.
+    if processes is None:
+        processes = get_attribute_processes()
+
+    tasks = [(index, process_fn, key, metadata) for index, (process_fn, key, metadata) in enumerate(tasks)]
+    if processes <= 1 or len(tasks) <= 1:
+        results = [process_source(task) for task in tasks]
+    else:
+        # the largest sources start first so they do not finish last
+        tasks = sorted(tasks, key=lambda task: -len(task[3].get('regions', {})))
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(processes=min(processes, len(tasks))) as pool:
+            results = list(pool.imap_unordered(process_source, tasks))
+        results = sorted(results, key=lambda result: result[0])
+
+    return [(attributes, seconds) for _, attributes, seconds in results]
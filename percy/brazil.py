@@ -1,45 +1,55 @@
 import pandas as pd
 from os import path, getcwd
-from fnc.sequences import groupby
 
-from percy.common import make_attributes
+from percy.common import get_subregion_keys, make_attributes
+from percy.references import load_reference
 
+ATTRIBUTE_COLUMNS = ['state', 'city', 'place_type', 'estimated_population_2019', 'city_ibge_code']
 
-def process_brazil(key, metadata):
-    key_list = []
-    population_list = []
-    area_km_list = []
+AREA_BY_CITY_FILE = path.join('raw', 'brazil', 'area_by_city.csv')
+AREA_BY_STATE_FILE = path.join('raw', 'brazil', 'area_by_state.csv')
 
-    area_by_city_df = pd.read_csv(path.join('raw', 'brazil', 'area_by_city.csv'))[
-        ['CD_GCMUN', 'AR_MUN_2018']].set_index('CD_GCMUN')
-    area_by_state_df = pd.read_csv(path.join('raw', 'brazil', 'area_by_state.csv'))[
-        ['CD_GCUF', 'AR_MUN_2018']].set_index('CD_GCUF')
 
+def read_area(filename, code_column):
+    # areas are written with a decimal comma
+    df = pd.read_csv(filename, usecols=[code_column, 'AR_MUN_2018'], decimal=',')
+    return df.set_index(code_column)['AR_MUN_2018']
 
-    parent_regions = [x for x in metadata['regions'].items() if 'parent' not in x[1]]
-    regions_by_parent = groupby([1, 'parent'], metadata['regions'].items())
 
-    for region_key, data in parent_regions:
-        df = pd.read_csv(path.join('inf-covid19-data', data['file']), parse_dates=False)
-        df = df[['state', 'city', 'place_type', 'estimated_population_2019', 'city_ibge_code']].drop_duplicates()
-        for _, row in df.iterrows():
-            code = row['city_ibge_code']
-            place_type = row['place_type']
-            population = row['estimated_population_2019']
+def get_area_by_city():
+    return load_reference('brazil_area_by_city', [AREA_BY_CITY_FILE], lambda: read_area(AREA_BY_CITY_FILE, 'CD_GCMUN'))
 
-            area_df = area_by_state_df if place_type == 'state' else area_by_city_df
-            if code not in area_df.index:
-                continue
 
-            area_km = float(area_df.loc[code]['AR_MUN_2018'].replace(',', '.'))
+def get_area_by_state():
+    return load_reference('brazil_area_by_state', [AREA_BY_STATE_FILE], lambda: read_area(AREA_BY_STATE_FILE, 'CD_GCUF'))
 
-            composed_key = f'{key}.regions.{region_key}'
-            if place_type == 'city':
-                [subregion_key] = [x[0] for x in regions_by_parent[region_key] if x[1]['name'] == row['city']]
-                composed_key = f'{key}.regions.{subregion_key}'
 
-            key_list.append(composed_key)
-            population_list.append(population)
-            area_km_list.append(area_km)
+def process_brazil(key, metadata):
+    area_by_city = get_area_by_city()
+    area_by_state = get_area_by_state()
 
-    return make_attributes(key_list, population_list, area_km_list)
+    parent_regions = [x for x in metadata['regions'].items() if 'parent' not in x[1]]
+    subregion_keys = get_subregion_keys(metadata)
+
+    attributes = []
+    for region_key, data in parent_regions:
+        df = pd.read_csv(path.join('inf-covid19-data', data['file']), usecols=ATTRIBUTE_COLUMNS, parse_dates=False)
+        df = df[ATTRIBUTE_COLUMNS].drop_duplicates()
+
+        is_state = df['place_type'] == 'state'
+        is_city = df['place_type'] == 'city'
+        area_km = df['city_ibge_code'].map(area_by_city).where(~is_state, df['city_ibge_code'].map(area_by_state))
+
+        subregion_key = df['city'].map(subregion_keys.get(region_key, {}))
+        composed_key = (f'{key}.regions.' + subregion_key).where(is_city, f'{key}.regions.{region_key}')
+
+        is_valid = area_km.notna() & composed_key.notna()
+        attributes.append(make_attributes(
+            composed_key[is_valid].to_numpy(),
+            df.loc[is_valid, 'estimated_population_2019'].to_numpy(),
+            area_km[is_valid].to_numpy(),
+        ))
+
+    if len(attributes) == 0:
+        return make_attributes([], [], [])
+    return pd.concat(attributes, ignore_index=True)
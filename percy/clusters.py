@@ -1,6 +1,10 @@
 import json
-from os import getcwd, path, getenv
+import hashlib
+import io
+from os import getcwd, path, getenv, makedirs
+from functools import lru_cache
 import logging
+import shutil
 
 import pandas as pd
 import numpy as np
@@ -8,18 +12,38 @@ from matplotlib import pyplot as plt
 from scipy.cluster.hierarchy import dendrogram
 from sklearn.datasets import load_iris
 from sklearn.cluster import AgglomerativeClustering
+from sklearn.neighbors import kneighbors_graph
 from sklearn.preprocessing import StandardScaler, MinMaxScaler
 from sklearn.manifold import SpectralEmbedding
-from sklearn.metrics.pairwise import paired_distances
 from sklearn import cluster, covariance, manifold
 
 from fnc.mappings import merge, get
 
+from percy.attributes import process_sources
 from percy.countries import process_country
+from percy.dtw import dtw, get_dtw_band, lb_keogh, lb_kim, manhattan
+from percy.metrics import metrics
 from percy.brazil import process_brazil
 from percy.sweden import process_sweden
 from percy.united_states_of_america import process_united_states_of_america
-from percy.common import normalize_timeline
+from percy.timelines import TimelineStore, feature_columns
+from percy.common import build_timeline, count_timeline_days, get_key_path, get_name_column, get_timeline_columns, parse_key, split_regions
+
+TOP_K = 100
+
+CLUSTERING_THRESHOLD = 0.1
+
+DISTANCE_FEATURES = ['cases', 'deaths', 'cases_per_100k', 'deaths_per_100k']
+DISTANCE_COLUMNS = [f'{feature}_distance' for feature in DISTANCE_FEATURES]
+
+METRICS = ['manhattan', 'dtw']
+# what get_distances_batch can compute, lower bounds included
+WINDOW_DISTANCES = {
+    'manhattan': manhattan,
+    'dtw': dtw,
+    'lb_kim': lb_kim,
+    'lb_keogh': lb_keogh,
+}
 
 COUNTRY_PROCESS_MAPPING = {
     'Brazil': process_brazil,
@@ -30,24 +54,25 @@ COUNTRY_PROCESS_MAPPING = {
 
 def process(metadata):
     logger = logging.getLogger('percy.server')
-    region_attributes = pd.DataFrame()
-
 
-    logger.debug('[process] starting...')
+    tasks = []
     for country, data in metadata.items():
-        logger.debug(f'[process] processing {country}...')
-        attributes = process_country(country, data)
-        if attributes is not None:
-            logger.debug(f'[process] concatening {country}...')
-            region_attributes = pd.concat([region_attributes, attributes], ignore_index=True)
-
+        tasks.append((process_country, country, data))
         if country in COUNTRY_PROCESS_MAPPING:
-            logger.debug(f'[process] processing regions from {country}...')
-            process_fn = COUNTRY_PROCESS_MAPPING[country]
-            subregion_attributes = process_fn(country, metadata[country])
-            logger.debug(f'[process] concatening regions from {country}...')
-            region_attributes = pd.concat([region_attributes, subregion_attributes], ignore_index=True)
+            tasks.append((COUNTRY_PROCESS_MAPPING[country], country, data))
 
+    logger.debug(f'[process] processing {len(tasks)} sources...')
+    results = process_sources(tasks)
+
+    timings = []
+    for (process_fn, country, _), (_, seconds) in zip(tasks, results):
+        logger.debug(f'[process] {process_fn.__name__}({country}) took {seconds:.3f}s')
+        timings.append((seconds, process_fn.__name__, country))
+    for seconds, name, country in sorted(timings, reverse=True)[:5]:
+        logger.info(f'[process] slowest: {name}({country}) took {seconds:.3f}s')
+
+    logger.debug('[process] concatenating attributes...')
+    region_attributes = pd.concat([attributes for attributes, _ in results if attributes is not None], ignore_index=True)
 
     logger.debug(f'[process] adding population density information...')
     region_attributes['population_density'] = region_attributes['population']/region_attributes['area_km']
@@ -55,25 +80,102 @@ def process(metadata):
     return process_with_days(metadata, region_attributes)
 
 
-def process_with_days(metadata, df):
+def process_with_days(metadata, df, keys=None):
     logger = logging.getLogger('percy.server')
+    rows = df if keys is None else df[df['key'].isin(keys)]
+    if len(rows) == 0:
+        return df
+
     logger.debug(f'[process_with_days] adding days information...')
-    df['days'] = df.apply(lambda r: len(get_timeline(metadata, r)), axis=1)
+    days = get_days(metadata, rows)
+    if 'days' in df.columns:
+        df.loc[rows.index, 'days'] = days
+    else:
+        df['days'] = days
     return df
 
 
-def per_similarity(region_attributes):
+def get_days(metadata, df):
+    # Timeline lengths counted straight from the source files, without
+    # building the timelines.
     logger = logging.getLogger('percy.server')
 
+    regions_by_file = {}
+    for key in df['key']:
+        region_data = get(get_key_path(key), metadata)
+        regions_by_file.setdefault(get('file', region_data), []).append((key, region_data))
+
+    days = {}
+    for filename, regions in regions_by_file.items():
+        try:
+            days.update(count_file_days(path.join('inf-covid19-data', filename), regions))
+        except Exception:
+            logger.warn(f'[get_days] unable to read {filename}')
+
+    return df['key'].map(days).fillna(0).astype(np.int64)
+
+
+def count_file_days(filename, regions):
+    columns = set()
+    for key, region_data in regions:
+        columns.update(get_timeline_columns(key)[:2])
+        if not parse_key(key)[2]:
+            columns.update(['place_type', get_name_column(region_data['place_type'])])
+
+    source_df = pd.read_csv(filename, usecols=lambda column: column in columns)
+
+    days = {}
+    regions_by_place_type = {}
+    for key, region_data in regions:
+        _, _, is_country = parse_key(key)
+        if is_country:
+            date_column, cases_column, _ = get_timeline_columns(key)
+            days[key] = count_timeline_days(source_df, date_column, cases_column, is_cumulative_sum=True).get(0, 0)
+        else:
+            regions_by_place_type.setdefault(region_data['place_type'], []).append((key, region_data['name']))
+
+    for place_type, names in regions_by_place_type.items():
+        date_column, cases_column, _ = get_timeline_columns(names[0][0])
+        place_df = source_df[source_df['place_type'] == place_type]
+        counts = count_timeline_days(place_df, date_column, cases_column, by=get_name_column(place_type))
+        for key, name in names:
+            days[key] = counts.get(name, 0)
+
+    return days
+
+
+def get_clustering_mode():
+    return getenv('SIMILARITY_CLUSTERING', 'agglomerative')
+
+
+def get_clustering_model(mode, n_samples):
+    # Both modes merge with Ward linkage up to the same distance threshold.
+    # `agglomerative` builds the full O(n²) linkage, while `connectivity`
+    # only considers merges along a k-nearest-neighbours graph, which keeps
+    # memory linear in the number of regions.
+    if mode == 'connectivity':
+        n_neighbors = min(int(getenv('SIMILARITY_CLUSTERING_NEIGHBORS', 30)), n_samples - 1)
+        return AgglomerativeClustering(distance_threshold=CLUSTERING_THRESHOLD, n_clusters=None,
+            connectivity=lambda X: kneighbors_graph(X, n_neighbors, include_self=False))
+
+    return AgglomerativeClustering(distance_threshold=CLUSTERING_THRESHOLD, n_clusters=None)
+
+
+def per_similarity(region_attributes, mode=None):
+    logger = logging.getLogger('percy.server')
+
+    if mode is None:
+        mode = get_clustering_mode()
+
     logger.debug('[per_similarity] selecting features...')
     df = region_attributes[['population', 'area_km']]
     logger.debug('[per_similarity] converting to numpy...')
     X = df.to_numpy()
     logger.debug('[per_similarity] apply standard scaler...')
     X_std = StandardScaler().fit_transform(X)
-    logger.debug('[per_similarity] instantiate agglomerative clustering...')
-    model = AgglomerativeClustering(distance_threshold=0.1, n_clusters=None)
-    logger.debug('[per_similarity] fit agglomerative clustering...')
+    logger.debug(f'[per_similarity] instantiate {mode} clustering...')
+    model = get_clustering_model(mode, len(X_std))
+    logger.debug(f'[per_similarity] fit {mode} clustering...')
     model = model.fit(X_std)
     return model
 
@@ -90,8 +192,25 @@ def should_get_distances(a_timeline, b_timeline):
     return True
 
 
+def should_get_distances_batch(a_lengths, b_lengths):
+    return (np.minimum(a_lengths, b_lengths) > 0) & (b_lengths >= a_lengths - 30)
+
+
+def get_time_window():
+    return int(getenv('SIMILARITY_TIME_WINDOW', 10))
+
+
+def get_metric():
+    return getenv('SIMILARITY_METRIC', 'manhattan')
+
+
+def get_output_name(name, metric):
+    # outputs of the default metric keep their original names
+    return name if metric == 'manhattan' else f'{name}_{metric}'
+
+
 def normalize_timelines(A, B):
-    TIMELINE_WINDOW = 0 - int(getenv('SIMILARITY_TIME_WINDOW', 10))
+    TIMELINE_WINDOW = 0 - get_time_window()
     length = min(len(A), len(B))
     return A[:length][TIMELINE_WINDOW:], B[:length][TIMELINE_WINDOW:]
 
@@ -107,119 +226,388 @@ def get_distances(a_timeline, b_timeline):
     return cases_distance, deaths_distance, cases_per_100k_distance, deaths_per_100k_distance
 
 
-def per_single_timeline(metadata, a_key, df):
-    data = []
+def get_distances_batch(store, a_rows, b_rows, tail=None, metric='manhattan'):
+    # Weighted manhattan distance of every (a_rows[i], b_rows[i]) pair on all
+    # DISTANCE_FEATURES, matching get_distances for each pair, or any other
+    # of WINDOW_DISTANCES. With `tail`, only the last `tail` days of each
+    # window are summed, which gives a lower bound of the full distance.
+    distances = np.zeros((len(a_rows), len(DISTANCE_FEATURES)))
+    if len(a_rows) == 0:
+        return distances
+
+    lengths = np.minimum(store.lengths[a_rows], store.lengths[b_rows])
+    window = get_time_window()
+    windows = np.minimum(lengths, window) if window > 0 else lengths
+    columns = store.columns(DISTANCE_FEATURES)
+    window_distance = WINDOW_DISTANCES[metric]
+    band = get_dtw_band()
+
+    for n in np.unique(windows):
+        if n == 0:
+            continue
+
+        m = n if tail is None else min(tail, n)
+        selected = np.nonzero(windows == n)[0]
+        days = (lengths[selected] - m)[:, None] + np.arange(m)
+
+        A = gather_days(store, a_rows[selected], days, columns)
+        B = gather_days(store, b_rows[selected], days, columns)
+
+        weights = get_window_weights(n)
+        distances[selected] = window_distance(A, B, weights[n-m:], band) / weights.sum()
+
+    return distances
+
+
+def gather_days(store, rows, days, columns):
+    days = store.offsets[rows][:, None] + days
+    return store.values[rows[:, None, None], days[:, :, None], columns[None, None, :]]
+
+
+def get_finite_mask(distances):
+    # pairs with a missing or infinite value in their windows, such as the
+    # per 100k features of regions without a population, are left out
+    return np.isfinite(distances).all(axis=1)
+
+
+def get_top_k_mask(distances, k):
+    # Rows within the k smallest distances of any feature, ties included.
+    if len(distances) == 0:
+        return np.zeros(0, dtype=bool)
+
+    k = min(k, len(distances))
+    targets = np.partition(distances, k-1, axis=0)[k-1]
+    return (distances <= targets).any(axis=1)
+
+
+def get_lower_bound_days():
+    return int(getenv('SIMILARITY_LOWER_BOUND_DAYS', 3))
+
+
+def get_lower_bounds(metric):
+    # cheapest first, each one tighter than the previous
+    if metric == 'dtw':
+        return [{'metric': 'lb_kim'}, {'metric': 'lb_keogh'}]
+    return [{'tail': get_lower_bound_days()}]
+
+
+def get_top_k_distances(store, a_index, b_rows, is_same_cluster, k, metric='manhattan'):
+    # Exact distances for the same-cluster candidates and for every candidate
+    # that can be within the top k of some feature. Candidates whose lower
+    # bound is already above the current k-th best distance are skipped, and
+    # the tighter bounds are only computed for the remaining ones.
+    distances = np.full((len(b_rows), len(DISTANCE_FEATURES)), np.nan)
+    evaluated = np.zeros(len(b_rows), dtype=bool)
+    a_rows = np.full(len(b_rows), a_index)
+
+    def evaluate(candidates):
+        candidates = candidates & ~evaluated
+        if not candidates.any():
+            return False
+        selected = np.nonzero(candidates)[0]
+        # non-finite distances never make it into the top k
+        batch = get_distances_batch(store, a_rows[selected], b_rows[selected], metric=metric)
+        distances[selected] = np.where(np.isfinite(batch), batch, np.inf)
+        evaluated[selected] = True
+        return True
+
+    if len(b_rows) <= k:
+        evaluate(np.ones(len(b_rows), dtype=bool))
+        return evaluated, distances
+
+    lower_bounds = get_lower_bounds(metric)
+    bounds = get_distances_batch(store, a_rows, b_rows, **lower_bounds[0])
+    # number of lower bounds computed for each candidate
+    levels = np.ones(len(b_rows), dtype=np.int64)
+
+    def refine(candidates, feature, target):
+        for level, lower_bound in enumerate(lower_bounds[1:], start=1):
+            selected = np.nonzero(candidates & (levels == level))[0]
+            if len(selected) > 0:
+                bounds[selected] = np.maximum(bounds[selected], get_distances_batch(store, a_rows[selected], b_rows[selected], **lower_bound))
+                levels[selected] += 1
+            candidates = candidates & (bounds[:, feature] <= target)
+        return candidates
+
+    evaluate(is_same_cluster)
+    for feature in range(len(DISTANCE_FEATURES)):
+        first = np.zeros(len(b_rows), dtype=bool)
+        first[np.argsort(bounds[:, feature], kind='stable')[:k]] = True
+        evaluate(first)
+
+        while True:
+            target = np.partition(distances[evaluated, feature], k-1)[k-1]
+            if not evaluate(refine(~evaluated & (bounds[:, feature] <= target), feature, target)):
+                break
+
+    return evaluated, distances
+
+
+def per_single_timeline(metadata, a_key, df, store=None, top_k=None, metric='manhattan'):
+    if store is None:
+        store = timeline_store
+
     columns=['region', 'cases_distance', 'deaths_distance', 'cases_per_100k_distance', 'deaths_per_100k_distance', 'is_same_cluster']
     
     a_df = df[df['key'] == a_key]
     if len(a_df) == 0:
-        return pd.DataFrame(data, columns=columns)
-
-    a_row = a_df.iloc[0]
-    a_cluster = a_row['cluster']
-    a_timeline = get_timeline(metadata, a_row)
-    
-    for i, b_row in df.iterrows():
-        b_key = b_row['key']
+        return pd.DataFrame([], columns=columns)
+
+    a_cluster = a_df.iloc[0]['cluster']
+    b_df = df[df['key'] != a_key]
+    positions = {key: position for position, key in enumerate(b_df['key'])}
+
+    # The other regions are compared chunk by chunk, within the store budget,
+    # and the top k of each chunk is kept until the top k of all of them is
+    # known. Timelines may be reloaded or evicted by other threads in
+    # between, so the lock is held throughout.
+    results = []
+    with store.lock:
+        for chunk in iter_loaded_chunks(metadata, b_df, store, keep=[a_key]):
+            # rows move when the store grows or shrinks, and a_key is dropped
+            # when its source file changes
+            load_timelines(metadata, a_df, store)
+            a_index = store.row(a_key)
+            b_rows = store.rows(chunk['key'].tolist())
+            a_rows = np.full(len(b_rows), a_index)
+
+            eligible = should_get_distances_batch(store.lengths[a_rows], store.lengths[b_rows])
+            b_keys = chunk['key'].to_numpy()[eligible]
+            b_rows = b_rows[eligible]
+            is_same_cluster = chunk['cluster'].to_numpy()[eligible] == a_cluster
+
+            if top_k is None:
+                distances = get_distances_batch(store, a_rows[eligible], b_rows, metric=metric)
+                metrics.inc('percy_pairs_evaluated_total', len(b_rows))
+                selected = np.nonzero(get_finite_mask(distances))[0]
+            else:
+                evaluated, distances = get_top_k_distances(store, a_index, b_rows, is_same_cluster, top_k, metric)
+                metrics.inc('percy_pairs_evaluated_total', int(evaluated.sum()))
+                metrics.inc('percy_pairs_pruned_total', int((~evaluated).sum()))
+                selected = np.nonzero(evaluated)[0]
+                selected = selected[get_finite_mask(distances[selected])]
+                selected = selected[get_top_k_mask(distances[selected], top_k) | is_same_cluster[selected]]
+            if len(selected) == 0:
+                continue
 
-        if a_key == b_key:
-            continue
+            result = pd.DataFrame(distances[selected], columns=DISTANCE_COLUMNS)
+            result.insert(0, 'region', b_keys[selected])
+            result['is_same_cluster'] = is_same_cluster[selected]
+            results.append(result)
 
-        b_cluster = b_row['cluster']
-        b_timeline = get_timeline(metadata, b_row)
+        store.evict()
 
-        if not should_get_distances(a_timeline, b_timeline):
-            continue
+    if len(results) == 0:
+        return pd.DataFrame([], columns=columns)
 
-        try:
-            cases_distance, deaths_distance, cases_per_100k_distance, deaths_per_100k_distance = get_distances(a_timeline, b_timeline)
-            data.append([
-                b_key,
-                cases_distance,
-                deaths_distance,
-                cases_per_100k_distance,
-                deaths_per_100k_distance,
-                a_cluster == b_cluster,
-            ])
-        except:
-            logger = logging.getLogger('percy.server')
-            logger.warn(f"[per_single_timeline] unable to compare {a_key} to {b_key}")
-
-
-    df = pd.DataFrame(data, columns=columns)
+    # chunks follow the source files, regions are returned in the order of df
+    df = pd.concat(results, ignore_index=True)
+    df = df.iloc[np.argsort(df['region'].map(positions).to_numpy(), kind='stable')].reset_index(drop=True)
+    if top_k is not None:
+        df = df[get_top_k_mask(df[DISTANCE_COLUMNS].to_numpy(), top_k) | df['is_same_cluster'].to_numpy()].reset_index(drop=True)
     return df
 
 
-def per_timeline(metadata, df, offset=0):
+def per_timeline(metadata, df, offset=0, store=None):
+    if store is None:
+        store = timeline_store
+
     data = []
 
-    idx = offset+1
-    count = len(df)
-    for _, a_row in df[offset:offset+500].iterrows():
-        a_key = a_row['key']
-        a_cluster = a_row['cluster']
-        a_timeline = get_timeline(metadata, a_row)
+    # timelines may be reloaded or evicted by other threads in between
+    with store.lock:
+        load_timelines(metadata, df, store)
 
-        print('  ', str(idx).rjust(len(str(count)), ' '), '/', count)
+        keys = df['key'].to_numpy()
+        clusters = df['cluster'].to_numpy()
+        rows = store.rows(keys.tolist())
 
-        for _, b_row in df.iloc[idx:].iterrows():
-            b_key = b_row['key']
-            b_cluster = b_row['cluster']
-            b_timeline = get_timeline(metadata, b_row)
+        idx = offset+1
+        count = len(df)
+        for a_key, a_cluster, a_index in zip(keys[offset:offset+500], clusters[offset:offset+500], rows[offset:offset+500]):
+            print('  ', str(idx).rjust(len(str(count)), ' '), '/', count)
 
-            if not should_get_distances(a_timeline, b_timeline):
-                continue
+            b_rows = rows[idx:]
+            a_rows = np.full(len(b_rows), a_index)
+            eligible = should_get_distances_batch(store.lengths[a_rows], store.lengths[b_rows])
 
-            cases_distance, deaths_distance, cases_per_100k_distance, deaths_per_100k_distance = get_distances(a_timeline, b_timeline)
+            distances = get_distances_batch(store, a_rows[eligible], b_rows[eligible])
+            finite = get_finite_mask(distances)
+            pairs = pd.DataFrame(distances[finite], columns=DISTANCE_COLUMNS)
+            pairs.insert(0, 'region_a', a_key)
+            pairs.insert(1, 'region_b', keys[idx:][eligible][finite])
+            pairs['is_same_cluster'] = clusters[idx:][eligible][finite] == a_cluster
+            data.append(pairs)
+            idx += 1
 
-            data.append([
-                a_key,
-                b_key,
-                cases_distance,
-                deaths_distance,
-                cases_per_100k_distance,
-                deaths_per_100k_distance,
-                a_cluster == b_cluster,
-            ])
-        idx += 1
+        store.evict()
+
+        columns = ['region_a', 'region_b'] + DISTANCE_COLUMNS + ['is_same_cluster']
+        if len(data) == 0:
+            return pd.DataFrame([], columns=columns)
+
+        df = pd.concat(data, ignore_index=True)
+        return df
 
-    df = pd.DataFrame(data, columns=['region_a', 'region_b', 'cases_distance', 'deaths_distance', 'cases_per_100k_distance', 'deaths_per_100k_distance', 'is_same_cluster'])
-    return df
+
+@lru_cache(maxsize=None)
+def get_window_weights(length):
+    weights = np.maximum(0.1, np.arange(1, length+1) / length)
+    weights.setflags(write=False)
+    return weights
 
 
 def get_distance(A, B, features, metric='manhattan'):
-    length = len(A)
-    distances = paired_distances(A[features], B[features], metric='manhattan')
-    return np.average(distances, weights=[max(0.1, x/length) for x in range(1, length+1)])
+    columns = feature_columns(features)
+    if metric != 'manhattan':
+        weights = get_window_weights(len(A))
+        return WINDOW_DISTANCES[metric](A[None, :, columns], B[None, :, columns], weights, get_dtw_band()).sum() / weights.sum()
+
+    distances = np.abs(A[:, columns] - B[:, columns]).sum(axis=1)
+    return np.average(distances, weights=get_window_weights(len(A)))
 
 
-timeline_cache = {}
+timeline_store = TimelineStore(getenv('TIMELINE_DTYPE', 'float64'), budget=int(getenv('TIMELINE_CACHE_BYTES', 0)))
 
-def get_timeline(metadata, row):
+def load_timelines(metadata, df, store=None):
     logger = logging.getLogger('percy.server')
-    key = row['key']
-    population = row['population']
 
+    if store is None:
+        store = timeline_store
+
+    # a single load at a time, so concurrent callers do not read the same files
+    with store.lock:
+        store.refresh()
+
+        keys = df['key'].tolist()
+        missing = set(store.lookup(keys))
+
+        regions_by_file = {}
+        for key, population in zip(keys, df['population']):
+            if key not in missing:
+                continue
+            missing.discard(key)
+            region_data = get(get_key_path(key), metadata)
+            filename = get('file', region_data)
+            regions_by_file.setdefault(filename, []).append((key, population, region_data))
+
+        if len(regions_by_file) == 0:
+            return
+
+        logger.debug(f'[load_timelines] loading {len(regions_by_file)} files...')
+        timelines = {}
+        for filename, regions in regions_by_file.items():
+            region_keys = [key for key, _, _ in regions]
+            digest = None
+            if filename is None:
+                # tracked so that they are looked up again on the next load
+                for key in region_keys:
+                    timelines[key] = pd.DataFrame()
+                store.track(None, None, region_keys)
+                continue
+
+            try:
+                filename = path.join('inf-covid19-data', filename)
+                with open(filename, 'rb') as f:
+                    content = f.read()
+                digest = hashlib.sha256(content).hexdigest()
+                source_df = pd.read_csv(io.BytesIO(content), parse_dates=True)
+                source_regions = split_regions(source_df)
+            except Exception:
+                logger.warn(f'[load_timelines] unable to read {filename}')
+                for key in region_keys:
+                    timelines[key] = pd.DataFrame()
+                continue
+            finally:
+                store.track(filename, digest, region_keys)
+
+            for key, population, region_data in regions:
+                timelines[key] = build_region_timeline(key, source_df, source_regions, region_data, population)
+
+        store.update(timelines)
+
+
+def get_chunk_size(store, count):
+    # regions loaded at once: all of them without a budget, otherwise as
+    # many as the budget holds (a year of days until a row is allocated)
+    if store.budget is None:
+        return max(count, 1)
+    row_nbytes = store.row_nbytes or 366 * len(store.features) * store.dtype.itemsize
+    return max(1, store.budget // row_nbytes)
+
+
+def iter_loaded_chunks(metadata, df, store=None, keep=()):
+    # Yields the regions of `df` in chunks that fit the store budget, each
+    # one while its timelines are loaded. Chunks follow the source files so
+    # a file is read once per pass. The store lock is held throughout and
+    # the least recently used regions, other than `keep`, are evicted after
+    # every chunk.
+    if store is None:
+        store = timeline_store
+
+    files = np.array([get(get_key_path(key) + ['file'], metadata) or '' for key in df['key']], dtype=object)
+    df = df.iloc[np.argsort(files, kind='stable')]
+
+    with store.lock:
+        start = 0
+        while start < len(df):
+            chunk = df.iloc[start:start + get_chunk_size(store, len(df))]
+            load_timelines(metadata, chunk, store)
+            yield chunk
+            store.evict(keep=keep)
+            start += len(chunk)
+
+
+def save_timelines(metadata, df, directory, store=None, features=DISTANCE_FEATURES):
+    # Saves the timelines of `df`, in its order, as one store in `directory`
+    # that processes memory-map. Each chunk of loaded regions is saved on its
+    # own, then they are merged.
+    if store is None:
+        store = timeline_store
+
+    parts = []
+    for chunk in iter_loaded_chunks(metadata, df, store):
+        part = path.join(directory, 'parts', str(len(parts)))
+        makedirs(part)
+        store.compact(chunk['key'].tolist(), features).save(part)
+        parts.append(part)
+
+    TimelineStore.concat(parts, directory, df['key'].tolist())
+    shutil.rmtree(path.join(directory, 'parts'), ignore_errors=True)
+
+
+def build_region_timeline(key, source_df, source_regions, region_data, population):
     try:
-        if key not in timeline_cache:
-            key_path = key.split('.regions.')
-            is_country = len(key_path) == 1
+        _, _, is_country = parse_key(key)
+        date_column, cases_column, deaths_column = get_timeline_columns(key)
+
+        region_df = source_df
+        if not is_country:
+            region_df = source_regions.get((region_data['place_type'], region_data['name']), source_df.iloc[:0])
+
+        df = build_timeline(region_df, date_column, cases_column, deaths_column, is_country)
 
-            if not is_country:
-                country, region = key_path
-                key_path = [country, 'regions', region]
+        df['cases_per_100k'] = df['cases'] / population * 100000
+        df['deaths_per_100k'] = df['deaths'] / population * 100000
 
-            filename = get(key_path + ['file'], metadata)
+        return df
+    except Exception:
+        return pd.DataFrame()
 
-            df = pd.read_csv(path.join('inf-covid19-data', filename), parse_dates=True)
 
-            df = normalize_timeline(key, df, get(key_path, metadata))
+def get_timeline(metadata, row, store=None):
+    if store is None:
+        store = timeline_store
 
-            df['cases_per_100k'] = df['cases'] / population * 100000
-            df['deaths_per_100k'] = df['deaths'] / population * 100000
+    key = row['key']
 
-            timeline_cache[key] = df
+    try:
+        with store.lock:
+            if key not in store:
+                load_timelines(metadata, pd.DataFrame([row]), store)
 
-        return timeline_cache[key].copy()
+            timeline = store.get(key)
+            store.evict(keep=[key])
+            return timeline
     except Exception as e:
         return pd.DataFrame()
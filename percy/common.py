@@ -1,8 +1,8 @@
 import pandas as pd
+import numpy as np
 from os import path
 
 from fnc.mappings import merge, get
-from datetime import timedelta
 
 from percy.utils import checksum
 
@@ -15,6 +15,8 @@ def make_attributes(key_list, population_list, area_km_list):
     })
 
 
+TIMELINE_COLUMNS = ['date', 'cases', 'cases_daily', 'deaths', 'deaths_daily']
+
 PLACE_TYPE_COLUMN_MAPPING = {
     'state': "state",
     'city': "city",
@@ -30,7 +32,7 @@ REGION_CUSTOM_CONFIG = {
 }
 
 
-def normalize_timeline(key, df, region_data):
+def get_timeline_columns(key):
     country, region, is_country = parse_key(key)
 
     date_column = 'dateRep' if is_country else get(
@@ -40,59 +42,124 @@ def normalize_timeline(key, df, region_data):
     deaths_column = 'deaths' if is_country else get(
         [country, 'columns', 'deaths'], REGION_CUSTOM_CONFIG, default='deaths')
 
+    return date_column, cases_column, deaths_column
+
+
+def get_name_column(place_type):
+    return get(place_type, PLACE_TYPE_COLUMN_MAPPING, default='region')
+
+
+def normalize_timeline(key, df, region_data):
+    country, region, is_country = parse_key(key)
+    date_column, cases_column, deaths_column = get_timeline_columns(key)
+
     if not is_country:
-        name_column = get(region_data['place_type'],
-                          PLACE_TYPE_COLUMN_MAPPING, default='region')
+        name_column = get_name_column(region_data['place_type'])
         df = df[df['place_type'] == region_data['place_type']]
         df = df[df[name_column] == region_data['name']]
 
-    df[date_column] = pd.to_datetime(df[date_column])
-    df = df.sort_values(by=[date_column], ascending=[True])
+    return build_timeline(df, date_column, cases_column, deaths_column, is_country)
+
 
+def split_regions(df):
+    regions = {}
+    if 'place_type' not in df.columns:
+        return regions
+
+    for place_type, place_df in df.groupby('place_type'):
+        name_column = get_name_column(place_type)
+        if name_column not in place_df.columns:
+            continue
+        for name, region_df in place_df.groupby(name_column):
+            regions[(place_type, name)] = region_df
+
+    return regions
+
+
+def get_key_path(key):
+    country, region, is_country = parse_key(key)
     if is_country:
-        df[cases_column] = df[cases_column].cumsum()
-        df[deaths_column] = df[deaths_column].cumsum()
-
-    df = df[df[cases_column] > 0]
-
-    prev_date = None
-    prev_cases = 0
-    prev_deaths = 0
-
-    timeline = []
-    for _, row in df.iterrows():
-        date = row[date_column]
-
-        if prev_date and (date - prev_date).days > 1:
-            missing_date = prev_date + timedelta(days=1)
-            while (date - missing_date).days >= 1:
-                timeline.append([
-                    missing_date,
-                    prev_cases,
-                    0,
-                    prev_deaths,
-                    0
-                ])
-                missing_date = missing_date + timedelta(days=1)
-
-        cases = row[cases_column]
-        cases_daily = max(0, cases - prev_cases)
-        deaths = row[deaths_column]
-        deaths_daily = max(0, deaths - prev_deaths)
-
-        timeline.append([
-            date,
-            cases,
-            cases_daily,
-            deaths,
-            deaths_daily
-        ])
-
-        prev_cases = cases
-        prev_deaths = deaths
-        prev_date = date
-
-    return pd.DataFrame(timeline, columns=['date', 'cases', 'cases_daily', 'deaths', 'deaths_daily'])
+        return [key]
+    return [country, 'regions', region]
+
+
+def get_subregion_keys(metadata):
+    # name -> region key of the subregions of each parent region
+    subregion_keys = {}
+    for region_key, data in metadata['regions'].items():
+        if 'parent' in data:
+            subregion_keys.setdefault(data['parent'], {})[data['name']] = region_key
+    return subregion_keys
+
+
+def build_timeline(df, date_column, cases_column, deaths_column, is_cumulative_sum=False):
+    dates = pd.to_datetime(df[date_column])
+    df = pd.DataFrame({
+        'date': dates,
+        'cases': df[cases_column],
+        'deaths': df[deaths_column],
+    }).sort_values(by=['date'], ascending=[True])
+
+    if is_cumulative_sum:
+        df['cases'] = df['cases'].cumsum()
+        df['deaths'] = df['deaths'].cumsum()
+
+    df = df[df['cases'] > 0]
+
+    if len(df) == 0:
+        return pd.DataFrame([], columns=TIMELINE_COLUMNS)
+
+    cases = df['cases'].to_numpy()
+    deaths = df['deaths'].to_numpy()
+    dates = df['date'].to_numpy()
+
+    # daily values are clipped at zero and count NaN steps as zero
+    cases_daily = np.nan_to_num(np.clip(np.diff(cases, prepend=0), 0, None))
+    deaths_daily = np.nan_to_num(np.clip(np.diff(deaths, prepend=0), 0, None))
+
+    timeline = pd.DataFrame({
+        'date': dates,
+        'cases': cases,
+        'cases_daily': cases_daily,
+        'deaths': deaths,
+        'deaths_daily': deaths_daily,
+    })
+
+    # missing dates repeat the previous cumulative values with no daily change
+    all_dates = pd.date_range(dates[0], dates[-1], freq='D')
+    missing_dates = all_dates[~all_dates.isin(dates)]
+    if len(missing_dates) > 0:
+        previous = np.searchsorted(dates, missing_dates.to_numpy(), side='right') - 1
+        missing = pd.DataFrame({
+            'date': missing_dates,
+            'cases': cases[previous],
+            'cases_daily': np.zeros(len(missing_dates), dtype=cases_daily.dtype),
+            'deaths': deaths[previous],
+            'deaths_daily': np.zeros(len(missing_dates), dtype=deaths_daily.dtype),
+        })
+        timeline = pd.concat([timeline, missing], ignore_index=True)
+        timeline = timeline.sort_values(by=['date'], kind='mergesort', ignore_index=True)
+
+    return timeline
+
+
+def count_timeline_days(df, date_column, cases_column, by=None, is_cumulative_sum=False):
+    # Length of the timelines build_timeline would return for each group of
+    # `by` (or for the whole frame, as group 0): the rows with cases plus
+    # the missing dates between the first and the last of them.
+    df = pd.DataFrame({
+        'date': pd.to_datetime(df[date_column]),
+        'cases': df[cases_column],
+        'group': 0 if by is None else df[by],
+    })
+
+    if is_cumulative_sum:
+        df = df.sort_values(by=['date'], kind='mergesort')
+        df['cases'] = df.groupby('group')['cases'].cumsum()
+
+    dates = df.loc[df['cases'] > 0].groupby('group')['date']
+    span = (dates.max() - dates.min()).dt.days + 1
+    return (dates.count() + span - dates.nunique()).astype(int)
 
 
 def parse_key(key):
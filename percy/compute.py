@@ -0,0 +1,88 @@
+from os import getenv, getpid
+import cProfile
+import io
+import logging
+import multiprocessing
+import pstats
+import shutil
+import tempfile
+import weakref
+
+from percy.clusters import per_single_timeline, save_timelines
+from percy.metrics import metrics
+from percy.timelines import TimelineStore
+
+PROFILE_LINES = 60
+
+# State of a compute process, set once by its initializer.
+shared = {}
+
+
+def get_compute_processes():
+    return int(getenv('SIMILARITY_COMPUTE_PROCESSES', multiprocessing.cpu_count()))
+
+
+class ComputePool(object):
+    # Spawned processes do not inherit the server threads or import
+    # percy.server, and receive the metadata and regions once. The
+    # timelines are saved once and memory-mapped by every process, so
+    # processes can be added without loading them again.
+    def __init__(self, metadata, df, processes=None, store=None):
+        logger = logging.getLogger('percy.server')
+
+        if processes is None:
+            processes = get_compute_processes()
+
+        self.directory = tempfile.mkdtemp(prefix='percy-')
+        # also removed at exit when the pool is never stopped
+        self.remove_directory = weakref.finalize(self, shutil.rmtree, self.directory, ignore_errors=True)
+        try:
+            logger.debug(f'[ComputePool] saving the timelines of {len(df)} regions...')
+            save_timelines(metadata, df, self.directory, store)
+
+            context = multiprocessing.get_context('spawn')
+            self.pool = context.Pool(processes=processes, initializer=init_compute_worker, initargs=(self.directory, metadata, df))
+        except:
+            self.remove_directory()
+            raise
+
+    def apply(self, func, args=()):
+        return self.pool.apply(func, args)
+
+    def stop(self):
+        # running jobs finish before the timelines are removed
+        self.pool.close()
+        self.pool.join()
+        self.remove_directory()
+
+
+def create_compute_pool(metadata, df, processes=None, store=None):
+    return ComputePool(metadata, df, processes, store)
+
+
+def init_compute_worker(directory, metadata, df):
+    shared['metadata'] = metadata
+    shared['df'] = df
+    shared['store'] = TimelineStore.load(directory, mmap_mode='r')
+
+
+def compute_region(region, top_k=None, profile=False, metric='manhattan'):
+    # Also returns the metrics recorded since the previous job and, when
+    # asked, the profile of this one.
+    profiler = cProfile.Profile() if profile else None
+    with metrics.span('region.per_single_timeline'):
+        if profiler is not None:
+            profiler.enable()
+        try:
+            df = per_single_timeline(shared['metadata'], region, shared['df'], shared['store'], top_k=top_k, metric=metric)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+
+    report = None
+    if profiler is not None:
+        output = io.StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(PROFILE_LINES)
+        report = output.getvalue()
+
+    return df, getpid(), shared['store'].stats(), metrics.drain(), report
@@ -4,28 +4,29 @@ from os import path
 
 
 from percy.common import normalize_timeline, make_attributes
+from percy.references import load_reference
+
+
+AREA_BY_COUNTRY_FILE = path.join('raw', 'area_by_country.csv')
+
+POPULATION_COLUMNS = ['popData2019', 'popData2018']
 
 
 def area_by_country():
-    df = pd.read_csv(path.join('raw', 'area_by_country.csv'))
-    area_map = {}
-    for _, row in df.iterrows():
-        year = 2019
-        code = row["Country Code"]
-        area = np.nan
-        for year in range(2019, 1959, -1):
-            year_area = row[str(year)]
-            if np.isnan(year_area):
-                continue
-            area = year_area
-            break
-        if not np.isnan(area):
-            area_map[code] = area
-    return area_map
+    # latest known area of each country
+    df = pd.read_csv(AREA_BY_COUNTRY_FILE)
+    years = [str(year) for year in range(2019, 1959, -1) if str(year) in df.columns]
+    area = df[years].bfill(axis=1).iloc[:, 0]
+    area.index = df['Country Code']
+    return area.dropna()
+
+
+def get_area_by_country():
+    return load_reference('area_by_country', [AREA_BY_COUNTRY_FILE], area_by_country)
 
 
 def process_country(key, metadata):
-    area_map = area_by_country()
+    area_map = get_area_by_country()
     code = metadata['countryTerritoryCode']
 
     timeline = []
@@ -34,10 +35,11 @@ def process_country(key, metadata):
 
     area_km = area_map[code]
 
+    # only the population of the first row is needed
     df = pd.read_csv(
         path.join('inf-covid19-data', metadata['file']),
-        parse_dates=[0],
-        dayfirst=True,
+        usecols=lambda column: column in POPULATION_COLUMNS,
+        nrows=1,
     )
 
     population = get_population(df)
@@ -48,8 +50,7 @@ def process_country(key, metadata):
 
 
 def get_population(df):
-    keys = ['popData2019', 'popData2018']
-    for key in keys:
+    for key in POPULATION_COLUMNS:
         try:
             return df[key].iloc[0]
         except:
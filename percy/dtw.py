@@ -0,0 +1,78 @@
+from os import getenv
+
+import numpy as np
+
+# The distances below compare batches of equal-length windows: A and B are
+# (pairs x days x features) arrays and `weights` has one weight per day.
+# Matching day i of A with day j of B costs weights[max(i, j)] * |a_i - b_j|,
+# so with a band of 0 the DTW distance is the weighted manhattan distance,
+# which is also an upper bound of it for any band. Results are per pair and
+# feature, not yet divided by the sum of the weights.
+
+
+def get_dtw_band():
+    # Sakoe-Chiba band: day i of one region is matched with days i - band
+    # to i + band of the other
+    return int(getenv('SIMILARITY_DTW_BAND', 3))
+
+
+def manhattan(A, B, weights, band=None):
+    return np.einsum('pdf,d->pf', np.abs(A - B), weights)
+
+
+def dtw(A, B, weights, band):
+    # D[i, d] is the cost of the best path ending at day i of A and day
+    # i + d - band of B; each step works on all pairs and features at once
+    n = A.shape[1]
+    band = min(band, n - 1)
+    width = 2 * band + 1
+    D = np.full((n, width) + A.shape[:1] + A.shape[2:], np.inf)
+
+    for i in range(n):
+        for d in range(width):
+            j = i + d - band
+            if j < 0 or j >= n:
+                continue
+
+            cost = weights[max(i, j)] * np.abs(A[:, i] - B[:, j])
+            if i == 0 and j == 0:
+                D[i, d] = cost
+                continue
+
+            best = np.full_like(cost, np.inf)
+            if i > 0:
+                # (i - 1, j - 1) and (i - 1, j)
+                best = np.minimum(best, D[i - 1, d])
+                if d + 1 < width:
+                    best = np.minimum(best, D[i - 1, d + 1])
+            if d > 0:
+                # (i, j - 1)
+                best = np.minimum(best, D[i, d - 1])
+            D[i, d] = cost + best
+
+    return D[n - 1, band]
+
+
+def lb_kim(A, B, weights, band=None):
+    # every path starts at the first days and ends at the last ones
+    bound = weights[0] * np.abs(A[:, 0] - B[:, 0])
+    if A.shape[1] > 1:
+        bound = bound + weights[-1] * np.abs(A[:, -1] - B[:, -1])
+    return bound
+
+
+def lb_keogh(A, B, weights, band):
+    # Every path matches day i of A with some day of B within the band, at a
+    # cost of at least weights[i] times the distance of a_i to the envelope
+    # of B around day i, since the weights grow with the days.
+    n = B.shape[1]
+    upper = B.copy()
+    lower = B.copy()
+    for shift in range(1, min(band, n - 1) + 1):
+        upper[:, shift:] = np.maximum(upper[:, shift:], B[:, :-shift])
+        upper[:, :-shift] = np.maximum(upper[:, :-shift], B[:, shift:])
+        lower[:, shift:] = np.minimum(lower[:, shift:], B[:, :-shift])
+        lower[:, :-shift] = np.minimum(lower[:, :-shift], B[:, shift:])
+
+    excess = np.maximum(A - upper, 0) + np.maximum(lower - A, 0)
+    return np.einsum('pdf,d->pf', excess, weights)
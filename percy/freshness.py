@@ -0,0 +1,51 @@
+import logging
+import subprocess
+import time
+import threading as th
+
+
+class FreshnessIndex(object):
+    # Last commit (or write) time of every file in a repository, so request
+    # handlers can check a file's age without running git.
+    def __init__(self, repo):
+        self.repo = repo
+        self.timestamps = {}
+        self.lock = th.Lock()
+
+    def build(self):
+        logger = logging.getLogger('percy.server')
+
+        timestamps = {}
+        try:
+            # NUL-separated, so paths with non-ASCII characters are not quoted
+            result = subprocess.run(['git', '-C', self.repo, 'log', '-z', '--name-only', '--format=@%ct'], stdout=subprocess.PIPE, check=True)
+
+            timestamp = 0
+            for entry in result.stdout.decode('utf-8', 'surrogateescape').split('\0'):
+                # the first file of a commit follows its header on a new line
+                if entry.startswith('\n'):
+                    entry = entry[1:]
+                if entry.startswith('@') and entry[1:].isdigit():
+                    timestamp = int(entry[1:])
+                elif entry:
+                    # newest commits come first
+                    timestamps.setdefault(entry, timestamp)
+        except:
+            logger.error(f'[FreshnessIndex] unable to read the history of {self.repo}.')
+
+        with self.lock:
+            # files written since the last commit keep their write time
+            for filename, timestamp in self.timestamps.items():
+                if timestamp > timestamps.get(filename, 0):
+                    timestamps[filename] = timestamp
+            self.timestamps = timestamps
+
+    def get(self, filename):
+        return self.timestamps.get(filename, 0)
+
+    def touch(self, filename, timestamp=None):
+        with self.lock:
+            self.timestamps[filename] = int(time.time() if timestamp is None else timestamp)
+
+    def is_up_to_date(self, filename, max_age=60 * 60 * 24):
+        return time.time() - self.get(filename) < max_age
@@ -0,0 +1,108 @@
+import hashlib
+import logging
+from os import path
+
+import numpy as np
+import pandas as pd
+from fnc.mappings import get
+
+from percy.clusters import iter_loaded_chunks, timeline_store
+from percy.common import get_key_path
+from percy.utils import checksum
+
+WATERMARK_COLUMNS = ['key', 'file', 'checksum', 'last_date', 'days', 'digest']
+
+
+def get_region_files(metadata, keys):
+    return pd.Series([get(get_key_path(key) + ['file'], metadata) for key in keys], index=keys, dtype=object)
+
+
+def get_file_checksums(files):
+    checksums = {}
+    for filename in set(files):
+        try:
+            checksums[filename] = checksum(path.join('inf-covid19-data', filename))
+        except Exception:
+            checksums[filename] = None
+    return checksums
+
+
+def get_watermarks(store, keys, files, checksums):
+    data = []
+    with store.lock:
+        for key in keys:
+            row = store.row(key)
+            length = int(store.lengths[row])
+            offset = int(store.offsets[row])
+
+            last_date = None
+            if length > 0:
+                last_date = str(store.origin + np.timedelta64(offset + length - 1, 'D'))
+
+            digest = hashlib.sha1(store.view(key).tobytes())
+            digest.update(str(last_date).encode())
+
+            data.append([key, files[key], checksums.get(files[key]), last_date, length, digest.hexdigest()])
+
+    return pd.DataFrame(data, columns=WATERMARK_COLUMNS)
+
+
+def compute_watermarks(metadata, df, store=None, files=None, checksums=None):
+    # Watermarks of the regions of `df`, taken chunk by chunk while their
+    # timelines are loaded, so the store can stay within its budget.
+    if store is None:
+        store = timeline_store
+
+    keys = df['key'].tolist()
+    if files is None:
+        files = get_region_files(metadata, keys)
+    if checksums is None:
+        checksums = get_file_checksums(files.dropna())
+
+    parts = [get_watermarks(store, chunk['key'].tolist(), files, checksums) for chunk in iter_loaded_chunks(metadata, df, store)]
+    if len(parts) == 0:
+        return pd.DataFrame([], columns=WATERMARK_COLUMNS)
+    return pd.concat(parts).set_index('key').reindex(keys).reset_index()[WATERMARK_COLUMNS]
+
+
+def load_watermarks(filename):
+    try:
+        return pd.read_csv(filename, dtype={'checksum': object, 'last_date': object, 'digest': object})
+    except Exception:
+        return pd.DataFrame([], columns=WATERMARK_COLUMNS)
+
+
+def save_watermarks(watermarks, filename):
+    watermarks.to_csv(filename, index=False)
+
+
+def get_changed_regions(metadata, df, watermarks, store=None):
+    # Regions whose timeline differs from the previous watermark. Only the
+    # source files whose checksum moved are parsed again.
+    logger = logging.getLogger('percy.server')
+
+    if store is None:
+        store = timeline_store
+
+    keys = df['key'].tolist()
+    files = get_region_files(metadata, keys)
+    checksums = get_file_checksums(files.dropna())
+
+    previous = watermarks.drop_duplicates('key').set_index('key').reindex(keys)
+    current_checksums = files.map(checksums)
+    is_stale = previous['checksum'].isna() | (previous['checksum'] != current_checksums)
+    stale_keys = is_stale[is_stale].index.tolist()
+
+    logger.debug(f'[get_changed_regions] {len(stale_keys)} regions with changed sources...')
+    stale_watermarks = compute_watermarks(metadata, df[df['key'].isin(stale_keys)], store, files, checksums)
+
+    previous_digests = previous['digest'].reindex(stale_keys).to_numpy()
+    changed = stale_watermarks.loc[stale_watermarks['digest'].to_numpy() != previous_digests, 'key'].tolist()
+
+    watermarks = pd.concat([
+        previous[~is_stale].reset_index().rename(columns={'index': 'key'}),
+        stale_watermarks,
+    ], ignore_index=True)[WATERMARK_COLUMNS]
+
+    return changed, watermarks
+
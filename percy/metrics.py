@@ -0,0 +1,106 @@
+from contextlib import contextmanager
+import threading as th
+import time
+
+COUNTER_HELP = {
+    'percy_pairs_evaluated_total': 'Pairs of regions whose distances were computed.',
+    'percy_pairs_pruned_total': 'Eligible pairs skipped by the top-k lower bound.',
+    'percy_publish_backpressure_total': 'Outputs that waited for a slow push before being queued.',
+    'percy_publish_failures_total': 'Batches that failed to be committed or pushed.',
+    'percy_published_outputs_total': 'Outputs committed and pushed to the similarity data repository.',
+    'percy_region_jobs_coalesced_total': 'Region requests merged into a queued or running job.',
+    'percy_region_jobs_total': 'Region jobs by outcome.',
+}
+
+
+class Metrics(object):
+    # Counters and stage timings of one process. Compute processes hand
+    # theirs back with `drain`, and the server `merge`s them before
+    # rendering everything in the Prometheus text format.
+    def __init__(self):
+        self.counters = {}
+        self.stages = {}
+        self.lock = th.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            count, total, _ = self.stages.get(stage, (0, 0.0, 0.0))
+            self.stages[stage] = (count + 1, total + seconds, seconds)
+
+    @contextmanager
+    def span(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def drain(self):
+        with self.lock:
+            snapshot = {'counters': self.counters, 'stages': self.stages}
+            self.counters = {}
+            self.stages = {}
+        return snapshot
+
+    def merge(self, snapshot):
+        with self.lock:
+            for key, value in snapshot['counters'].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for stage, (count, total, last) in snapshot['stages'].items():
+                previous_count, previous_total, _ = self.stages.get(stage, (0, 0.0, 0.0))
+                self.stages[stage] = (previous_count + count, previous_total + total, last)
+
+    def render(self, gauges=()):
+        # `gauges` are (name, labels, value) tuples read at scrape time
+        with self.lock:
+            counters = dict(self.counters)
+            stages = dict(self.stages)
+
+        lines = [
+            '# HELP percy_stage_seconds Time spent in each stage of the bootstrap and region jobs.',
+            '# TYPE percy_stage_seconds summary',
+        ]
+        for stage, (count, total, _) in sorted(stages.items()):
+            lines.append(f'percy_stage_seconds_count{format_labels({"stage": stage})} {count}')
+            lines.append(f'percy_stage_seconds_sum{format_labels({"stage": stage})} {total:.6f}')
+
+        lines += [
+            '# HELP percy_stage_last_seconds Duration of the last run of each stage.',
+            '# TYPE percy_stage_last_seconds gauge',
+        ]
+        for stage, (_, _, last) in sorted(stages.items()):
+            lines.append(f'percy_stage_last_seconds{format_labels({"stage": stage})} {last:.6f}')
+
+        for name in sorted(set(COUNTER_HELP) | {name for name, _ in counters}):
+            lines.append(f'# HELP {name} {COUNTER_HELP.get(name, name)}')
+            lines.append(f'# TYPE {name} counter')
+            values = sorted((labels, value) for (counter, labels), value in counters.items() if counter == name)
+            for labels, value in values or [((), 0)]:
+                lines.append(f'{name}{format_labels(dict(labels))} {value}')
+
+        names = []
+        for name, _, _ in gauges:
+            if name not in names:
+                names.append(name)
+        for name in names:
+            lines.append(f'# TYPE {name} gauge')
+            for gauge, labels, value in gauges:
+                if gauge == name and value is not None:
+                    lines.append(f'{name}{format_labels(labels)} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = [(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in labels.items()]
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+metrics = Metrics()
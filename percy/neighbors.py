@@ -0,0 +1,158 @@
+from contextlib import contextmanager
+from os import getenv, makedirs, path, replace, stat
+import fcntl
+import threading as th
+
+import numpy as np
+
+from percy.clusters import get_output_name
+
+# records smaller than this are never compacted
+MIN_COMPACT_BYTES = 1024 * 1024
+
+
+def get_neighbors_dir(metric):
+    return path.join(getenv('SIMILARITY_CACHE_DIR', 'cache'), get_output_name('neighbors', metric))
+
+
+class NeighborIndex(object):
+    # The regions listed in the by_key output of every region, so the
+    # outputs that include a changed region are found without reading them.
+    #
+    # Keys get int32 ids in the order they are first seen (keys.txt), and
+    # every update is appended to a log of int32 records: region, count and
+    # neighbors (log.bin). Several processes can share the directory: they
+    # append under a file lock and read what the others appended since
+    # their last read. The log is rewritten with the live records once it
+    # holds more than twice their size.
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = th.Lock()
+        makedirs(directory, exist_ok=True)
+        self._reset()
+
+    def _reset(self):
+        self.keys = []
+        self.ids = {}
+        self.neighbors = {}
+        self.keys_read = 0
+        self.log_read = 0
+        self.log_inode = None
+
+    def update(self, outputs):
+        # `outputs` maps regions to the regions listed in their output
+        if len(outputs) == 0:
+            return
+
+        with self.lock, self._file_lock():
+            self._sync()
+
+            new_keys = []
+            for region, neighbors in outputs.items():
+                for key in [region, *neighbors]:
+                    if key not in self.ids:
+                        self.ids[key] = len(self.keys)
+                        self.keys.append(key)
+                        new_keys.append(key)
+
+            records = []
+            for region, neighbors in outputs.items():
+                ids = np.fromiter((self.ids[key] for key in neighbors), dtype=np.int32, count=len(neighbors))
+                self.neighbors[self.ids[region]] = ids
+                records += [np.array([self.ids[region], len(ids)], dtype=np.int32), ids]
+
+            if len(new_keys) > 0:
+                with open(self._filename('keys.txt'), 'ab') as f:
+                    f.write(''.join(f'{key}\n' for key in new_keys).encode('utf-8'))
+                self.keys_read = stat(self._filename('keys.txt')).st_size
+
+            with open(self._filename('log.bin'), 'ab') as f:
+                f.write(np.concatenate(records).tobytes())
+            self.log_read = stat(self._filename('log.bin')).st_size
+            self.log_inode = stat(self._filename('log.bin')).st_ino
+
+            live_bytes = sum(8 + 4 * len(ids) for ids in self.neighbors.values())
+            if self.log_read > max(2 * live_bytes, MIN_COMPACT_BYTES):
+                self._compact()
+
+    def get_affected(self, changed):
+        # The changed regions, the regions their outputs list, and the
+        # regions whose outputs list one of them.
+        with self.lock, self._file_lock():
+            self._sync()
+
+            affected = set(changed)
+            changed_ids = np.array([self.ids[key] for key in changed if key in self.ids], dtype=np.int32)
+            if len(changed_ids) == 0:
+                return affected
+
+            for region in changed_ids:
+                affected.update(self.keys[neighbor] for neighbor in self.neighbors.get(region, []))
+            for region, neighbors in self.neighbors.items():
+                if np.isin(neighbors, changed_ids).any():
+                    affected.add(self.keys[region])
+            return affected
+
+    @contextmanager
+    def _file_lock(self):
+        with open(self._filename('lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _filename(self, name):
+        return path.join(self.directory, name)
+
+    def _sync(self):
+        # reads the keys and records appended by other processes
+        try:
+            info = stat(self._filename('log.bin'))
+        except OSError:
+            info = None
+        if info is not None and self.log_inode is not None and info.st_ino != self.log_inode:
+            # compacted by another process
+            self._reset()
+
+        if path.isfile(self._filename('keys.txt')):
+            with open(self._filename('keys.txt'), 'rb') as f:
+                f.seek(self.keys_read)
+                data = f.read()
+            end = data.rfind(b'\n') + 1
+            for key in data[:end].decode('utf-8').splitlines():
+                self.ids[key] = len(self.keys)
+                self.keys.append(key)
+            self.keys_read += end
+
+        if info is None:
+            return
+
+        with open(self._filename('log.bin'), 'rb') as f:
+            f.seek(self.log_read)
+            data = f.read()
+        values = np.frombuffer(data[:len(data) - len(data) % 4], dtype=np.int32)
+
+        position = 0
+        while position + 2 <= len(values):
+            region, count = int(values[position]), int(values[position + 1])
+            if position + 2 + count > len(values):
+                break
+            self.neighbors[region] = values[position + 2:position + 2 + count].copy()
+            position += 2 + count
+        self.log_read += 4 * position
+        self.log_inode = info.st_ino
+
+    def _compact(self):
+        records = []
+        for region, ids in self.neighbors.items():
+            records += [np.array([region, len(ids)], dtype=np.int32), ids]
+
+        partial = self._filename('log.bin.partial')
+        with open(partial, 'wb') as f:
+            f.write(np.concatenate(records).tobytes())
+        replace(partial, self._filename('log.bin'))
+
+        info = stat(self._filename('log.bin'))
+        self.log_read = info.st_size
+        self.log_inode = info.st_ino
@@ -0,0 +1,191 @@
+from os import getenv
+import logging
+import multiprocessing as mp
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from percy.clusters import DISTANCE_FEATURES, DISTANCE_COLUMNS, TOP_K, get_distances_batch, get_finite_mask, get_lower_bounds, save_timelines, should_get_distances_batch, timeline_store
+from percy.metrics import metrics
+from percy.timelines import TimelineStore
+
+shared = {}
+
+
+def get_block_size():
+    return int(getenv('SIMILARITY_BLOCK_SIZE', 256))
+
+
+def get_processes():
+    return int(getenv('SIMILARITY_PROCESSES', mp.cpu_count()))
+
+
+def iter_blocks(count, block_size):
+    starts = range(0, count, block_size)
+    for a_start in starts:
+        for b_start in starts:
+            if b_start < a_start:
+                continue
+            yield (a_start, min(a_start + block_size, count), b_start, min(b_start + block_size, count))
+
+
+def get_block_rows(store, block, dirty=None):
+    # Every eligible pair (a, b) with a < b, a in [a_start, a_stop) and b in
+    # [b_start, b_stop), in the same orientation as per_timeline. With a
+    # `dirty` mask, only pairs touching a dirty row are computed.
+    a_start, a_stop, b_start, b_stop = block
+    a_rows, b_rows = np.meshgrid(np.arange(a_start, a_stop), np.arange(b_start, b_stop), indexing='ij')
+    a_rows, b_rows = a_rows.ravel(), b_rows.ravel()
+
+    selected = (a_rows < b_rows) & should_get_distances_batch(store.lengths[a_rows], store.lengths[b_rows])
+    if dirty is not None:
+        selected &= dirty[a_rows] | dirty[b_rows]
+    return a_rows[selected], b_rows[selected]
+
+
+def get_block_pairs(store, clusters, block, dirty=None, metric='manhattan', thresholds=None):
+    # With `thresholds`, pairs that are not in the same cluster and whose
+    # lower bounds exceed the thresholds of both regions are left out.
+    a_rows, b_rows = get_block_rows(store, block, dirty)
+    is_same_cluster = clusters[a_rows] == clusters[b_rows]
+
+    if thresholds is not None:
+        targets = np.maximum(thresholds[a_rows], thresholds[b_rows])
+        for lower_bound in get_lower_bounds(metric):
+            bounds = get_distances_batch(store, a_rows, b_rows, **lower_bound)
+            selected = is_same_cluster | (bounds <= targets).any(axis=1)
+            a_rows, b_rows, targets, is_same_cluster = a_rows[selected], b_rows[selected], targets[selected], is_same_cluster[selected]
+
+    distances = get_distances_batch(store, a_rows, b_rows, metric=metric)
+    finite = get_finite_mask(distances)
+
+    return a_rows[finite].astype(np.int32), b_rows[finite].astype(np.int32), distances[finite], is_same_cluster[finite]
+
+
+def get_block_thresholds(store, block, dirty, k):
+    # The k smallest manhattan distances of every row of the block on each
+    # side, as (rows, k smallest) pairs. Manhattan distances are upper bounds
+    # of the DTW ones, so the k-th smallest bounds the DTW top k of a row.
+    a_start, a_stop, b_start, b_stop = block
+    a_rows, b_rows = get_block_rows(store, block, dirty)
+    distances = get_distances_batch(store, a_rows, b_rows)
+
+    matrix = np.full((a_stop - a_start, b_stop - b_start, len(DISTANCE_FEATURES)), np.inf)
+    matrix[a_rows - a_start, b_rows - b_start] = np.where(np.isfinite(distances), distances, np.inf)
+
+    results = []
+    for rows, values in [(np.arange(a_start, a_stop), matrix), (np.arange(b_start, b_stop), matrix.transpose(1, 0, 2))]:
+        if values.shape[1] > k:
+            values = np.partition(values, k - 1, axis=1)[:, :k]
+        results.append((rows, values.transpose(0, 2, 1)))
+    return results
+
+
+def merge_thresholds(smallest, rows, values, k):
+    values = np.concatenate([smallest[rows], values], axis=2)
+    smallest[rows] = np.partition(values, k - 1, axis=2)[:, :, :k]
+
+
+def init_block_worker(directory, metric, k):
+    shared['directory'] = directory
+    shared['metric'] = metric
+    shared['k'] = k
+    shared['store'] = TimelineStore.load(directory, mmap_mode='r')
+    shared['clusters'] = np.load(f'{directory}/clusters.npy')
+    shared['dirty'] = np.load(f'{directory}/dirty.npy')
+
+
+def thresholds_worker(block):
+    return get_block_thresholds(shared['store'], block, shared['dirty'], shared['k'])
+
+
+def block_worker(block):
+    thresholds = None
+    if shared['metric'] != 'manhattan':
+        # written once the thresholds pass is over
+        if 'thresholds' not in shared:
+            shared['thresholds'] = np.load(f'{shared["directory"]}/thresholds.npy')
+        thresholds = shared['thresholds']
+    return get_block_pairs(shared['store'], shared['clusters'], block, shared['dirty'], shared['metric'], thresholds)
+
+
+def iter_block_results(metadata, df, store=None, processes=None, block_size=None, dirty=None, metric='manhattan', k=TOP_K):
+    # Other metrics than manhattan take a first pass over the blocks to find
+    # the k-th smallest manhattan distance of every region, and only keep the
+    # pairs that can be within the top k of one of their regions or that are
+    # in the same cluster.
+    logger = logging.getLogger('percy.server')
+
+    if store is None:
+        store = timeline_store
+    if processes is None:
+        processes = get_processes()
+    if block_size is None:
+        block_size = get_block_size()
+
+    keys = df['key'].tolist()
+    if dirty is None:
+        dirty = np.ones(len(keys), dtype=bool)
+
+    blocks = [
+        block for block in iter_blocks(len(keys), block_size)
+        if dirty[block[0]:block[1]].any() or dirty[block[2]:block[3]].any()
+    ]
+
+    # workers read the timelines from a memory-mapped copy instead of
+    # receiving pickled metadata and attributes
+    directory = tempfile.mkdtemp(prefix='percy-')
+    try:
+        save_timelines(metadata, df, directory, store)
+        np.save(f'{directory}/clusters.npy', df['cluster'].to_numpy())
+        np.save(f'{directory}/dirty.npy', dirty)
+
+        logger.debug(f'[iter_block_results] computing {len(blocks)} blocks on {processes} processes...')
+        started_at = time.time()
+        with mp.Pool(processes=processes, initializer=init_block_worker, initargs=(directory, metric, k)) as pool:
+            if metric != 'manhattan':
+                logger.debug(f'[iter_block_results] computing the {metric} thresholds...')
+                smallest = np.full((len(keys), len(DISTANCE_FEATURES), k), np.inf)
+                for results in pool.imap_unordered(thresholds_worker, blocks):
+                    for rows, values in results:
+                        merge_thresholds(smallest, rows, values, k)
+                np.save(f'{directory}/thresholds.npy', smallest[:, :, k - 1])
+
+            for idx, result in enumerate(pool.imap_unordered(block_worker, blocks), start=1):
+                metrics.inc('percy_pairs_evaluated_total', len(result[0]))
+                yield result
+                logger.debug(f'[iter_block_results] {idx} / {len(blocks)} blocks')
+        logger.debug(f'[iter_block_results] done in {time.time() - started_at:.1f}s.')
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def per_timeline_blocks(metadata, df, store=None, processes=None, block_size=None, dirty=None, metric='manhattan'):
+    results = list(iter_block_results(metadata, df, store, processes, block_size, dirty, metric))
+    return get_pairs_frame(df['key'].tolist(), results)
+
+
+def per_timeline_shards(metadata, df, shards, store=None, processes=None, block_size=None, dirty=None, metric='manhattan'):
+    # Same pairs as per_timeline_blocks, appended to `shards` block by block.
+    for result in iter_block_results(metadata, df, store, processes, block_size, dirty, metric):
+        shards.append(*result)
+    shards.flush()
+    return shards
+
+
+def get_pairs_frame(keys, results):
+    columns = ['region_a', 'region_b'] + DISTANCE_COLUMNS + ['is_same_cluster']
+    if len(results) == 0:
+        return pd.DataFrame([], columns=columns)
+
+    keys = np.array(keys, dtype=object)
+    a_rows, b_rows, distances, is_same_cluster = (np.concatenate(parts) for parts in zip(*results))
+
+    df = pd.DataFrame(distances, columns=DISTANCE_COLUMNS)
+    df.insert(0, 'region_a', keys[a_rows])
+    df.insert(1, 'region_b', keys[b_rows])
+    df['is_same_cluster'] = is_same_cluster
+    return df
@@ -0,0 +1,107 @@
+from collections import OrderedDict
+import gzip
+import hashlib
+import threading as th
+
+from percy.storage import CSV_MEDIA_TYPE, serialize_frame
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+CSV_CONTENT_TYPE = 'text/plain; charset=UTF-8'
+
+
+class Payload(object):
+    # A response body serialized and compressed once, with its ETag.
+    def __init__(self, body, content_type=CSV_CONTENT_TYPE):
+        self.content_type = content_type
+        self.etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+        self.encodings = {
+            'identity': body,
+            'gzip': gzip.compress(body),
+        }
+        if brotli is not None:
+            self.encodings['br'] = brotli.compress(body)
+
+    @classmethod
+    def from_frame(cls, df, media_type=CSV_MEDIA_TYPE):
+        content_type = CSV_CONTENT_TYPE if media_type == CSV_MEDIA_TYPE else media_type
+        return cls(serialize_frame(df, media_type), content_type)
+
+    @property
+    def body(self):
+        return self.encodings['identity']
+
+    @property
+    def nbytes(self):
+        return sum(len(body) for body in self.encodings.values())
+
+    def matches(self, if_none_match):
+        if not if_none_match:
+            return False
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or self.etag in tags or f'W/{self.etag}' in tags
+
+    def encode(self, accept_encoding):
+        accepted = parse_accept_encoding(accept_encoding)
+        for encoding in ['br', 'gzip']:
+            if encoding in self.encodings and accepted.get(encoding, accepted.get('*', 0)) > 0:
+                return encoding, self.encodings[encoding]
+        return 'identity', self.body
+
+
+def parse_accept_encoding(accept_encoding):
+    accepted = {}
+    for part in (accept_encoding or '').split(','):
+        name, _, params = part.strip().partition(';')
+        if not name:
+            continue
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    return accepted
+
+
+class PayloadCache(object):
+    # Least recently used payloads are dropped once `budget` bytes are used.
+    def __init__(self, budget):
+        self.budget = budget
+        self.payloads = OrderedDict()
+        self.nbytes = 0
+        self.lock = th.Lock()
+
+    def __contains__(self, key):
+        return key in self.payloads
+
+    def get(self, key):
+        with self.lock:
+            payload = self.payloads.get(key)
+            if payload is not None:
+                self.payloads.move_to_end(key)
+            return payload
+
+    def put(self, key, payload):
+        with self.lock:
+            previous = self.payloads.pop(key, None)
+            if previous is not None:
+                self.nbytes -= previous.nbytes
+
+            self.payloads[key] = payload
+            self.nbytes += payload.nbytes
+
+            while self.nbytes > self.budget and len(self.payloads) > 1:
+                _, evicted = self.payloads.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def discard(self, key):
+        with self.lock:
+            payload = self.payloads.pop(key, None)
+            if payload is not None:
+                self.nbytes -= payload.nbytes
@@ -0,0 +1,119 @@
+import logging
+import threading as th
+import time
+import traceback
+
+from percy.metrics import metrics
+
+BATCH_SIZE = 50
+MAX_DELAY_SECONDS = 60
+BACKLOG = 500
+
+logger = logging.getLogger('percy.server')
+
+
+class Publisher(object):
+    # Collects the names of written outputs and runs `command` once per
+    # batch from a background thread: when `batch_size` outputs are pending
+    # or the oldest one waited `max_delay` seconds. While a batch is being
+    # pushed, `publish` blocks once `backlog` outputs are pending. Failed
+    # batches are merged into the next one. `lock` is held while `command`
+    # runs, so other writers of the repository can wait for it.
+    def __init__(self, command, batch_size=BATCH_SIZE, max_delay=MAX_DELAY_SECONDS, backlog=BACKLOG):
+        self.command = command
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.backlog = max(backlog, batch_size)
+
+        self.pending = set()
+        self.pending_since = None
+        self.is_publishing = False
+        self.flushes = 0
+        self.condition = th.Condition()
+        self.lock = th.Lock()
+
+        self.thread = th.Thread(target=self.work, name='publisher', daemon=True)
+        self.thread.start()
+
+    def publish(self, name):
+        with self.condition:
+            if len(self.pending) >= self.backlog and self.is_publishing:
+                metrics.inc('percy_publish_backpressure_total')
+                while len(self.pending) >= self.backlog and self.is_publishing:
+                    self.condition.wait()
+
+            self.pending.add(name)
+            if self.pending_since is None:
+                self.pending_since = time.monotonic()
+            self.condition.notify_all()
+
+    def flush(self, timeout=None):
+        # publishes what is pending now and waits for it
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            self.flushes += 1
+            self.condition.notify_all()
+            try:
+                while self.pending or self.is_publishing:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+                return True
+            finally:
+                self.flushes -= 1
+
+    def is_due(self, now):
+        return len(self.pending) >= self.batch_size or self.flushes > 0 or now - self.pending_since >= self.max_delay
+
+    def next_batch(self):
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                if not self.pending:
+                    self.condition.wait()
+                elif self.is_due(now):
+                    break
+                else:
+                    self.condition.wait(self.pending_since + self.max_delay - now)
+
+            batch = self.pending
+            self.pending = set()
+            self.pending_since = None
+            self.is_publishing = True
+            return batch
+
+    def work(self):
+        while True:
+            batch = self.next_batch()
+            try:
+                with self.lock, metrics.span('publish.commit_push'):
+                    self.command()
+                metrics.inc('percy_published_outputs_total', len(batch))
+                logger.info(f'[publisher] published {len(batch)} outputs.')
+                failed = False
+            except Exception:
+                metrics.inc('percy_publish_failures_total')
+                logger.error(f'[publisher] failed to publish {len(batch)} outputs.')
+                trace_info = traceback.format_exc().splitlines()
+                logger.error(f'[publisher]  ' + f'\n  '.join(trace_info))
+                failed = True
+
+            with self.condition:
+                self.is_publishing = False
+                if failed:
+                    # retried with the next batch, or after `max_delay`
+                    self.pending |= batch
+                    self.pending_since = time.monotonic()
+                self.condition.notify_all()
+
+            if failed and self.flushes > 0:
+                # do not spin on a remote that is down
+                time.sleep(min(self.max_delay, 5))
+
+    def stats(self):
+        with self.condition:
+            return {
+                'pending': len(self.pending),
+                'publishing': self.is_publishing,
+            }
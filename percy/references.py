@@ -0,0 +1,73 @@
+from os import getenv, getpid, makedirs, path, replace, stat
+import logging
+import threading as th
+
+import numpy as np
+import pandas as pd
+
+from percy.utils import checksum
+
+# Reference tables compiled from raw/, by name, with the signature of the
+# files they were built from.
+references = {}
+lock = th.Lock()
+
+
+def get_references_dir():
+    return path.join(getenv('SIMILARITY_CACHE_DIR', 'cache'), 'references')
+
+
+def get_signature(filenames):
+    signature = []
+    for filename in filenames:
+        info = stat(filename)
+        signature.append((filename, info.st_mtime_ns, info.st_size))
+    return tuple(signature)
+
+
+def load_reference(name, filenames, build):
+    # `build` returns a Series mapping codes to values. It only runs when
+    # the checksum of one of `filenames` differs from the compiled table.
+    signature = get_signature(filenames)
+    with lock:
+        if name in references and references[name][0] == signature:
+            return references[name][1]
+
+        logger = logging.getLogger('percy.server')
+        checksums = [checksum(filename) for filename in filenames]
+        reference_file = path.join(get_references_dir(), f'{name}.npz')
+
+        series = read_reference(reference_file, checksums)
+        if series is None:
+            logger.debug(f'[load_reference] compiling {name}...')
+            series = build()
+            write_reference(reference_file, series, checksums)
+
+        references[name] = (signature, series)
+        return series
+
+
+def read_reference(filename, checksums):
+    if not path.isfile(filename):
+        return None
+
+    try:
+        with np.load(filename, allow_pickle=False) as data:
+            if data['checksums'].tolist() != checksums:
+                return None
+            return pd.Series(data['values'], index=data['index'])
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def write_reference(filename, series, checksums):
+    makedirs(path.dirname(filename), exist_ok=True)
+    index = series.index.to_numpy()
+    if index.dtype == object:
+        index = index.astype(str)
+
+    # processes compiling the same table do not share a partial file
+    partial_filename = f'{filename}.{getpid()}.partial'
+    with open(partial_filename, 'wb') as f:
+        np.savez(f, index=index, values=series.to_numpy(), checksums=np.array(checksums))
+    replace(partial_filename, filename)
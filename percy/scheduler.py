@@ -0,0 +1,212 @@
+from collections import OrderedDict
+import heapq
+import itertools
+import logging
+import threading as th
+import time
+import traceback
+
+from percy.metrics import metrics
+
+RETRIES = 3
+BACKOFF_SECONDS = 30
+FAILURE_COOLDOWN_SECONDS = 10 * 60
+HISTORY = 1000
+DEMAND_HALF_LIFE_SECONDS = 60 * 60
+DEMAND_SIZE = 20000
+
+logger = logging.getLogger('percy.server')
+
+
+class Job(object):
+    def __init__(self, region, priority, profile):
+        self.region = region
+        self.priority = priority
+        self.profile = profile
+        self.status = 'queued'
+        self.attempts = 0
+        self.not_before = 0.0
+        self.finished_at = None
+
+
+class Scheduler(object):
+    # Runs `run(region, profile)` on `concurrency` threads, highest priority
+    # first. A region has at most one job queued or running: submitting it
+    # again only raises its priority. Failed jobs are retried `retries`
+    # times with an exponential backoff, and the outcome of the last
+    # `history` jobs is kept for /api/v1.
+    def __init__(self, run, concurrency, retries=RETRIES, backoff=BACKOFF_SECONDS,
+                 cooldown=FAILURE_COOLDOWN_SECONDS, history=HISTORY):
+        self.run = run
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.cooldown = cooldown
+        self.history = history
+
+        self.jobs = {}
+        self.finished = OrderedDict()
+        # (-priority, seq, region), entries of outdated priorities are skipped
+        self.queue = []
+        # (not_before, seq, region) of jobs waiting to be retried
+        self.delayed = []
+        self.sequence = itertools.count()
+        self.running = 0
+        self.condition = th.Condition()
+
+        self.threads = [th.Thread(target=self.work, name=f'scheduler-{i}', daemon=True) for i in range(concurrency)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, region, priority=0.0, profile=False):
+        with self.condition:
+            job = self.jobs.get(region)
+            if job is not None:
+                if job.status == 'in_progress':
+                    metrics.inc('percy_region_jobs_coalesced_total')
+                    return not profile or job.profile
+
+                metrics.inc('percy_region_jobs_coalesced_total')
+                job.profile = job.profile or profile
+                if priority > job.priority:
+                    job.priority = priority
+                    if job.status == 'queued':
+                        self.push(job)
+                return True
+
+            # a region that keeps failing is not retried on every request
+            finished = self.finished.get(region)
+            if finished is not None and finished.status == 'failed' and not profile:
+                if time.monotonic() - finished.finished_at < self.cooldown:
+                    return False
+
+            job = Job(region, priority, profile)
+            self.jobs[region] = job
+            self.push(job)
+            self.condition.notify()
+            return True
+
+    def cancel(self, region):
+        # only jobs that did not start can be cancelled
+        with self.condition:
+            job = self.jobs.get(region)
+            if job is None or job.status == 'in_progress':
+                return False
+            del self.jobs[region]
+            return True
+
+    def retain(self, regions):
+        with self.condition:
+            pending = [region for region, job in self.jobs.items() if job.status != 'in_progress']
+        return [region for region in pending if region not in regions and self.cancel(region)]
+
+    def is_active(self, region):
+        return region in self.jobs
+
+    def push(self, job):
+        heapq.heappush(self.queue, (-job.priority, next(self.sequence), job.region))
+
+    def next_job(self):
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                while self.delayed and self.delayed[0][0] <= now:
+                    _, _, region = heapq.heappop(self.delayed)
+                    job = self.jobs.get(region)
+                    if job is not None and job.status == 'retrying':
+                        job.status = 'queued'
+                        self.push(job)
+
+                while self.queue:
+                    priority, _, region = heapq.heappop(self.queue)
+                    job = self.jobs.get(region)
+                    if job is None or job.status != 'queued' or -priority != job.priority:
+                        continue
+                    job.status = 'in_progress'
+                    job.attempts += 1
+                    self.running += 1
+                    return job
+
+                self.condition.wait(self.delayed[0][0] - now if self.delayed else None)
+
+    def work(self):
+        while True:
+            job = self.next_job()
+            start = time.monotonic()
+            try:
+                self.run(job.region, job.profile)
+                failed = False
+            except Exception:
+                failed = True
+                trace_info = traceback.format_exc().splitlines()
+                logger.error(f'[scheduler<{job.region}>] attempt {job.attempts} failed.\n  ' + '\n  '.join(trace_info))
+
+            with self.condition:
+                self.running -= 1
+                if failed and job.attempts <= self.retries and self.jobs.get(job.region) is job:
+                    metrics.inc('percy_region_jobs_total', status='retried')
+                    job.status = 'retrying'
+                    job.not_before = time.monotonic() + self.backoff * 2 ** (job.attempts - 1)
+                    heapq.heappush(self.delayed, (job.not_before, next(self.sequence), job.region))
+                    self.condition.notify()
+                    continue
+
+                status = 'failed' if failed else 'done'
+                metrics.inc('percy_region_jobs_total', status=status)
+                metrics.observe('region.job', time.monotonic() - start)
+                job.status = status
+                job.finished_at = time.monotonic()
+                if self.jobs.get(job.region) is job:
+                    del self.jobs[job.region]
+                self.finished.pop(job.region, None)
+                self.finished[job.region] = job
+                while len(self.finished) > self.history:
+                    self.finished.popitem(last=False)
+
+    def statuses(self):
+        with self.condition:
+            statuses = {region: job.status for region, job in self.finished.items()}
+            statuses.update((region, job.status) for region, job in self.jobs.items())
+        return statuses
+
+    def stats(self):
+        with self.condition:
+            queued = sum(1 for job in self.jobs.values() if job.status == 'queued')
+            retrying = sum(1 for job in self.jobs.values() if job.status == 'retrying')
+            return {
+                'depth': queued,
+                'retrying': retrying,
+                'running': self.running,
+                'concurrency': self.concurrency,
+            }
+
+
+class Demand(object):
+    # Request counts of regions, halved every `half_life` seconds. Once more
+    # than `size` regions are tracked the least requested half is dropped.
+    def __init__(self, half_life=DEMAND_HALF_LIFE_SECONDS, size=DEMAND_SIZE):
+        self.half_life = half_life
+        self.size = size
+        self.scores = {}
+        self.lock = th.Lock()
+
+    def decay(self, score, updated_at, now):
+        return score * 0.5 ** ((now - updated_at) / self.half_life)
+
+    def hit(self, region):
+        now = time.monotonic()
+        with self.lock:
+            score, updated_at = self.scores.get(region, (0.0, now))
+            self.scores[region] = (self.decay(score, updated_at, now) + 1, now)
+
+            if len(self.scores) > self.size:
+                scores = sorted((self.decay(score, updated_at, now), region)
+                                for region, (score, updated_at) in self.scores.items())
+                for _, region in scores[:len(scores) // 2]:
+                    del self.scores[region]
+
+    def rate(self, region):
+        now = time.monotonic()
+        with self.lock:
+            score, updated_at = self.scores.get(region, (0.0, now))
+        return self.decay(score, updated_at, now)
@@ -1,5 +1,5 @@
-from flask import Flask, make_response
-from os import path, stat, getcwd
+from flask import Flask, make_response, request
+from os import path, stat, getcwd, getenv, makedirs
 import json
 import pandas as pd
 import numpy as np
@@ -12,7 +12,16 @@ import signal
 import traceback
 import logging
 
-from percy.clusters import process, process_with_days, per_similarity, per_single_timeline
+from percy.clusters import METRICS, TOP_K, get_metric, get_output_name, process, process_with_days, per_similarity, timeline_store
+from percy.compute import compute_region, create_compute_pool, get_compute_processes
+from percy.freshness import FreshnessIndex
+from percy.payloads import Payload, PayloadCache
+from percy.storage import CSV_MEDIA_TYPE, get_media_types, read_frame, write_frame
+from percy.metrics import metrics
+from percy.neighbors import NeighborIndex, get_neighbors_dir
+from percy.publisher import Publisher
+from percy.scheduler import Demand, Scheduler
+from percy.incremental import compute_watermarks, get_changed_regions, load_watermarks, save_watermarks
 from percy.common import metadata_changed
 
 app = Flask(__name__)
@@ -27,79 +36,129 @@ DATA = 'inf-covid19-data'
 SIMILARITY_DATA = 'inf-covid19-similarity-data'
 
 
-def update_data_repository():
-    try:
-        with Sultan.load() as s:
-            s.bash(path.join(getcwd(), 'commit-and-push.sh')).run()
-    except:
-        app.logger.error(f'[update_data_repository] failed.')
-        trace_info = traceback.format_exc().splitlines()
-        app.logger.error(f'[update_data_repository]  ' + f'\n  '.join(trace_info))
-        pass
+def get_payload_cache_bytes():
+    return int(getenv('PAYLOAD_CACHE_BYTES', 256 * 1024 * 1024))
 
 
-def get_latest_commit_date(repo, filename):
-    try:
-        with Sultan.load(env={'PAGER': 'cat'}) as s:
-            result = s.git(f'-C {repo} log -1 --format=%ct "{filename}"').run()
-            return int(''.join(result.stdout).strip())
-    except:
-        app.logger.error(f'[get_latest_commit_date] failed.')
-        trace_info = traceback.format_exc().splitlines()
-        app.logger.error(f'[get_latest_commit_date]  ' + f'\n  '.join(trace_info))
-        return 0
+def get_region_jobs():
+    return int(getenv('SIMILARITY_REGION_JOBS', get_compute_processes()))
+
+
+def get_job_retries():
+    return int(getenv('SIMILARITY_JOB_RETRIES', 3))
+
+
+def get_priority_sources():
+    # regions are prioritized by how often they are requested, their
+    # population, or both
+    return getenv('SIMILARITY_PRIORITY', 'requests,population').split(',')
+
+
+def is_profiling_enabled():
+    return getenv('PROFILING_ENABLED', '0') == '1'
+
+
+def get_publish_batch_size():
+    return int(getenv('SIMILARITY_PUBLISH_BATCH', 50))
+
+
+def get_publish_max_delay():
+    return float(getenv('SIMILARITY_PUBLISH_DELAY', 60))
 
 
-def bootstrap_worker(_metadata):
+def get_publish_backlog():
+    return int(getenv('SIMILARITY_PUBLISH_BACKLOG', 500))
+
+
+def update_data_repository():
+    # commits everything in SIMILARITY_DATA and pushes it to
+    # SIMILARITY_REMOTE. Only run by the publisher, which logs failures and
+    # retries them with the next batch, so errors are raised here.
+    with Sultan.load() as s:
+        s.bash(path.join(getcwd(), 'commit-and-push.sh')).run()
+
+
+def bootstrap_worker(_metadata, freshness, publisher, neighbors):
     app.logger.info(f"[bootstrap_worker] Starting worker...")
     try:
-        with Sultan.load() as s:
-            s.git(f'-C {DATA} pull --depth 1 origin master').run()
-            s.git(f'-C {SIMILARITY_DATA} pull --depth 1 origin master').run()
-
-        regions_file = path.join(SIMILARITY_DATA, 'regions.csv')
+        with metrics.span('bootstrap.git_pull'):
+            with Sultan.load() as s:
+                s.git(f'-C {DATA} pull --depth 1 origin master').run()
+                # not while the publisher commits and pushes
+                with publisher.lock:
+                    s.git(f'-C {SIMILARITY_DATA} pull --depth 1 origin master').run()
+
+        app.logger.info('[bootstrap_worker] Indexing file freshness...')
+        with metrics.span('bootstrap.freshness'):
+            freshness.build()
+
+        regions_file = path.join(SIMILARITY_DATA, 'regions')
+        watermarks_file = path.join(SIMILARITY_DATA, 'watermarks.csv')
         metadata_file = path.join('data', 'metadata.json')
 
         df = None
+        stale = set()
         metadata = _metadata.copy()
-        if metadata_changed() or not path.isfile(regions_file):
+        if metadata_changed() or not path.isfile(f'{regions_file}.csv'):
             app.logger.info('[bootstrap_worker] Loading metadata...')
-            with open(path.join(DATA, metadata_file)) as f:
-                metadata = json.load(f)
+            with metrics.span('bootstrap.metadata_load'):
+                with open(path.join(DATA, metadata_file)) as f:
+                    metadata = json.load(f)
 
             app.logger.info('[bootstrap_worker] Processing attributes...')
-            df = process(metadata)
+            with metrics.span('bootstrap.process'):
+                df = process(metadata)
 
             app.logger.info('[bootstrap_worker] Clustering by attributes...')
-            clusters = per_similarity(df)
+            with metrics.span('bootstrap.per_similarity'):
+                clusters = per_similarity(df)
             df['cluster'] = clusters.labels_
 
             df = df.sort_values(by=['cluster', 'key'])
 
             app.logger.info('[bootstrap_worker] Saving regions.csv...')
-            df.to_csv(regions_file, index=False)
+            with metrics.span('bootstrap.save'):
+                write_frame(df, regions_file)
+                freshness.touch('regions.csv')
+
+            with metrics.span('bootstrap.watermarks'):
+                keys = df['key'].tolist()
+                save_watermarks(compute_watermarks(metadata, df), watermarks_file)
+            stale.update(get_job_key(region, metric) for region in keys for metric in METRICS)
 
             app.logger.info('[bootstrap_worker] Commit and push...')
-            update_data_repository()
+            publisher.publish('regions.csv')
         else:
             app.logger.info('[bootstrap_worker] Loading attributes...')
-            is_up_to_date = time.time() - get_latest_commit_date(SIMILARITY_DATA,
-                                                                'regions.csv') < 60 * 60 * 24
-
             if len(metadata) == 0:
                 app.logger.info('[bootstrap_worker] Loading metadata...')
-                with open(path.join(DATA, metadata_file)) as f:
-                    metadata = json.load(f)
-
-            df = pd.read_csv(regions_file)
-            if not is_up_to_date:
-                app.logger.info('[bootstrap_worker] Updating attributes...')
-                df = process_with_days(metadata, df)
+                with metrics.span('bootstrap.metadata_load'):
+                    with open(path.join(DATA, metadata_file)) as f:
+                        metadata = json.load(f)
+
+            df = read_frame(regions_file)
+
+            app.logger.info('[bootstrap_worker] Looking for changed regions...')
+            with metrics.span('bootstrap.changed_regions'):
+                changed, watermarks = get_changed_regions(metadata, df, load_watermarks(watermarks_file))
+            if len(changed) > 0:
+                app.logger.info(f'[bootstrap_worker] Updating attributes of {len(changed)} regions...')
+                with metrics.span('bootstrap.process_with_days'):
+                    df = process_with_days(metadata, df, changed)
+                with metrics.span('bootstrap.save'):
+                    write_frame(df, regions_file)
+                    freshness.touch('regions.csv')
+
+                app.logger.info('[bootstrap_worker] Looking for regions paired with changed ones...')
+                with metrics.span('bootstrap.affected_regions'):
+                    for metric in METRICS:
+                        stale.update(get_job_key(region, metric) for region in neighbors[metric].get_affected(changed))
+            save_watermarks(watermarks, watermarks_file)
 
         len_clusters = len(df['cluster'].unique())
         app.logger.info(f'[bootstrap_worker] Loaded {len(df)} regions across {len_clusters} clusters.')
 
-        return df, metadata
+        return df, metadata, stale
     except:
         app.logger.error(f'[bootstrap_worker] failed.')
         trace_info = traceback.format_exc().splitlines()
@@ -107,48 +166,126 @@ def bootstrap_worker(_metadata):
             f'[bootstrap_worker]  ' + f'\n  '.join(trace_info))
 
 
-def region_worker(metadata, df, region):
-    app.logger.info(f"[region_worker<{region}>] Starting worker...")
+def get_top_k(metric):
+    # dtw distances are only kept for the nearest regions, so the lower
+    # bounds can skip most of them
+    top_k = int(getenv('SIMILARITY_TOP_K', 0)) or None
+    if top_k is None and metric != 'manhattan':
+        return TOP_K
+    return top_k
+
+
+def get_job_key(region, metric):
+    # regions containing ':' are always prefixed with their metric, so keys
+    # parse back unambiguously
+    if metric == 'manhattan' and ':' not in region:
+        return region
+    return f'{metric}:{region}'
+
+
+def parse_job_key(key):
+    metric, separator, region = key.partition(':')
+    if not separator:
+        return key, 'manhattan'
+    if metric not in METRICS:
+        raise ValueError(f'unknown metric in job key {key}')
+    return region, metric
+
+
+def region_worker(manager, compute_pool, region, profile=False, metric='manhattan'):
+    key = get_job_key(region, metric)
+    app.logger.info(f"[region_worker<{key}>] Starting worker...")
     try:
-        region_file = path.join(SIMILARITY_DATA, 'by_key', f'{region}.csv')
-        df = per_single_timeline(metadata, region, df)
-        df.to_csv(region_file, index=False)
-        update_data_repository()
-        app.logger.info(f"[region_worker<{region}>] done.")
+        directory = get_output_name('by_key', metric)
+        region_file = path.join(SIMILARITY_DATA, directory, region)
+        makedirs(path.join(SIMILARITY_DATA, directory), exist_ok=True)
+        with metrics.span('region.compute'):
+            df, pid, stats, snapshot, report = compute_pool.apply(compute_region, (region, get_top_k(metric), profile, metric))
+        manager.worker_stats[pid] = stats
+        metrics.merge(snapshot)
+        if report is not None:
+            manager.profiles[key] = report
+
+        with metrics.span('region.serialize'):
+            payload = Payload.from_frame(df)
+        with metrics.span('region.save'):
+            with open(f'{region_file}.csv', 'wb') as f:
+                f.write(payload.body)
+        manager.payloads.put((key, CSV_MEDIA_TYPE), payload)
+        manager.freshness.touch(path.join(directory, f'{region}.csv'))
+        manager.neighbors[metric].update({region: df['region'].tolist()})
+        manager.publisher.publish(path.join(directory, f'{region}.csv'))
+        app.logger.info(f"[region_worker<{key}>] done.")
     except:
-        app.logger.error(f'[region_worker<{region}>] failed.')
+        app.logger.error(f'[region_worker<{key}>] failed.')
         trace_info = traceback.format_exc().splitlines()
         app.logger.error(
-            f'[region_worker<{region}>]  ' + f'\n  '.join(trace_info))
+            f'[region_worker<{key}>]  ' + f'\n  '.join(trace_info))
+        # the scheduler retries failed jobs
+        raise
+
+
+def stop_compute_pool(compute_pool):
+    compute_pool.stop()
 
 
 class Manager(object):
     def __init__(self):
         self.pool = mp.Pool(processes=4)
+        self.compute_pool = None
+        self.worker_stats = {}
+        self.profiles = {}
+        self.freshness = FreshnessIndex(SIMILARITY_DATA)
+        self.neighbors = {metric: NeighborIndex(get_neighbors_dir(metric)) for metric in METRICS}
+        self.publisher = Publisher(update_data_repository, get_publish_batch_size(), get_publish_max_delay(), get_publish_backlog())
+        self.payloads = PayloadCache(get_payload_cache_bytes())
+        self.regions_payloads = {}
 
         self.metadata = {}
         self.df = None
+        self.populations = {}
 
-        self.region_results = {}
+        self.scheduler = Scheduler(self.run_region, get_region_jobs(), retries=get_job_retries())
+        self.demand = Demand()
+        self.stale_regions = set()
 
         self.bootstrap = None
+        self.is_bootstrapped = False
 
         self.pull()
 
     def pull(self):
         self.pulled_at = time.time()
-        self.bootstrap = self.pool.apply_async(
-            bootstrap_worker,
-            args=(self.metadata,),
-        )
+        self.is_bootstrapped = False
+        self.bootstrap = self.pool.apply_async(self.load)
+
+    def load(self):
+        # the compute pool is started with the bootstrap, not on the request
+        # path once it is over
+        result = bootstrap_worker(self.metadata, self.freshness, self.publisher, self.neighbors)
+        if result is None:
+            return None
+
+        df, metadata, stale = result
+        compute_pool = create_compute_pool(metadata, df)
+        # compute processes read the timelines the pool saved
+        timeline_store.clear()
+        return df, metadata, stale, compute_pool
 
     def is_loaded(self):
         return len(self.metadata) > 0 and self.df is not None
 
     def is_ready(self):
-        if self.bootstrap is not None:
+        if self.bootstrap is not None and not self.is_bootstrapped:
             try:
-                self.df, self.metadata = self.bootstrap.get(5)
+                self.df, self.metadata, stale, compute_pool = self.bootstrap.get(5)
+                self.replace_compute_pool(compute_pool)
+                self.stale_regions.update(stale)
+                self.populations = self.df.set_index('key')['population'].fillna(0).to_dict()
+                self.scheduler.retain({get_job_key(region, metric) for region in self.populations for metric in METRICS})
+                self.is_bootstrapped = True
+                self.regions_payloads = {}
+                self.payloads = PayloadCache(get_payload_cache_bytes())
             except:
                 pass
 
@@ -157,38 +294,100 @@ class Manager(object):
 
         return self.is_loaded()
 
-    def get_regions(self):
+    def replace_compute_pool(self, compute_pool):
+        previous_pool = self.compute_pool
+        self.compute_pool = compute_pool
+        self.worker_stats = {}
+        if previous_pool is not None:
+            # running jobs finish on the previous pool before it exits
+            th.Thread(target=stop_compute_pool, args=(previous_pool,), daemon=True).start()
+
+    def get_regions(self, media_type=CSV_MEDIA_TYPE):
         if not self.is_ready():
             return None
 
-        return self.df
-
-    def load_region(self, region):
-        if region not in self.region_results:
-            self.region_results[region] = self.pool.apply_async(
-                region_worker,
-                args=(self.metadata, self.df, region),
-            )
+        if media_type not in self.regions_payloads:
+            self.regions_payloads[media_type] = Payload.from_frame(self.df, media_type)
+        return self.regions_payloads[media_type]
+
+    def run_region(self, key, profile):
+        # jobs use the compute pool of the latest bootstrap
+        region, metric = parse_job_key(key)
+        region_worker(self, self.compute_pool, region, profile, metric)
+
+    def get_priority(self, region):
+        sources = get_priority_sources()
+        priority = 0.0
+        if 'population' in sources:
+            priority += np.log10(1 + max(self.populations.get(region, 0), 0))
+        if 'requests' in sources:
+            priority += np.log2(1 + self.demand.rate(region))
+        return float(priority)
+
+    def load_region(self, region, metric='manhattan'):
+        # a stale region whose job is running is computed again afterwards
+        key = get_job_key(region, metric)
+        if key in self.stale_regions and not self.scheduler.is_active(key):
+            self.stale_regions.discard(key)
+
+        self.scheduler.submit(key, self.get_priority(region))
+
+    def profile_region(self, region, metric='manhattan'):
+        # runs the region job again with cProfile, unless it is running
+        return self.scheduler.submit(get_job_key(region, metric), self.get_priority(region), profile=True)
+
+    def get_gauges(self):
+        gauges = []
+        stores = [('bootstrap', timeline_store.stats())]
+        stores += [(f'worker-{pid}', stats) for pid, stats in self.worker_stats.items()]
+        for process, stats in stores:
+            for name in ['hits', 'misses', 'evictions', 'regions', 'bytes']:
+                gauges.append((f'percy_timeline_cache_{name}', {'process': process}, stats[name]))
+
+        gauges.append(('percy_payload_cache_bytes', {}, self.payloads.nbytes))
+        gauges.append(('percy_payload_cache_entries', {}, len(self.payloads.payloads)))
+        gauges.append(('percy_stale_regions', {}, len(self.stale_regions)))
+        queue = self.scheduler.stats()
+        gauges.append(('percy_region_jobs_in_progress', {}, queue['running']))
+        gauges.append(('percy_region_jobs_queued', {}, queue['depth']))
+        gauges.append(('percy_region_jobs_retrying', {}, queue['retrying']))
+        publisher = self.publisher.stats()
+        gauges.append(('percy_publish_pending', {}, publisher['pending']))
+        gauges.append(('percy_publish_in_progress', {}, int(publisher['publishing'])))
+        gauges.append(('percy_ready', {}, int(self.is_loaded())))
+        return gauges
 
     def is_cacheable(self):
         return self.bootstrap is not None and self.bootstrap.ready()
 
-    def get_region(self, region):
+    def get_region(self, region, media_type=CSV_MEDIA_TYPE, metric='manhattan'):
         if not self.is_ready():
             return None, False
 
+        self.demand.hit(region)
+
         try:
-            region_file = path.join('by_key', f'{region}.csv')
-            is_up_to_date = time.time() - get_latest_commit_date(SIMILARITY_DATA,
-                                                                 region_file) < 60 * 60 * 24
+            key = get_job_key(region, metric)
+            directory = get_output_name('by_key', metric)
+            region_file = path.join(directory, f'{region}.csv')
+            is_up_to_date = self.freshness.is_up_to_date(region_file) and key not in self.stale_regions
             if not is_up_to_date:
-                self.load_region(region)
-            df = pd.read_csv(path.join(SIMILARITY_DATA, region_file))
-            return df, is_up_to_date
+                self.load_region(region, metric)
+
+            payload = self.payloads.get((key, media_type))
+            if payload is None:
+                if media_type == CSV_MEDIA_TYPE:
+                    with open(path.join(SIMILARITY_DATA, region_file), 'rb') as f:
+                        payload = Payload(f.read())
+                else:
+                    df = read_frame(path.join(SIMILARITY_DATA, directory, region))
+                    payload = Payload.from_frame(df, media_type)
+                self.payloads.put((key, media_type), payload)
+            return payload, is_up_to_date
         except:
             pass
 
-        self.load_region(region)
+        self.load_region(region, metric)
         return None, False
 
 
@@ -207,53 +406,97 @@ def health():
 
 @app.route('/api/v1')
 def index():
-    processes = dict()
-
     bootstrap = 'in_progress'
     if manager.bootstrap and manager.bootstrap.ready():
         bootstrap = 'done' if manager.bootstrap.successful() else 'failed'
 
-    for region, result in manager.region_results.items():
-        if result.ready():
-            processes[region] = 'done' if result.successful() else 'failed'
-        else:
-            processes[region] = 'in_progress'
-
     return {
         'ready': manager.is_ready(),
-        'processes': processes,
+        'processes': manager.scheduler.statuses(),
+        'queue': manager.scheduler.stats(),
+        'publisher': manager.publisher.stats(),
         'bootstrap': bootstrap,
+        'timeline_cache': {
+            'bootstrap': timeline_store.stats(),
+            'workers': list(manager.worker_stats.values()),
+        },
     }
 
 
+def get_media_type():
+    # CSV stays the default for clients that do not ask for a binary format.
+    return request.accept_mimetypes.best_match(get_media_types(), default=CSV_MEDIA_TYPE)
+
+
+def payload_response(payload, headers):
+    headers['ETag'] = payload.etag
+    headers['Vary'] = 'Accept, Accept-Encoding'
+
+    if payload.matches(request.headers.get('If-None-Match')):
+        return '', 304, headers
+
+    encoding, body = payload.encode(request.headers.get('Accept-Encoding'))
+    if encoding != 'identity':
+        headers['Content-Encoding'] = encoding
+    headers['Content-Type'] = payload.content_type
+
+    return body, 200, headers
+
+
 @app.route('/api/v1/regions')
 def list_regions():
-    df = manager.get_regions()
-    if df is None:
+    payload = manager.get_regions(get_media_type())
+    if payload is None:
         return '', 202, {'Cache-Control': 'no-store'}
 
-    headers = {
-        'Content-Type': 'text/plain; charset=UTF-8',
-    }
+    headers = {}
 
     if manager.is_cacheable():
         headers['Cache-Control'] = 'public, max-age=7200'
 
-    return df.to_csv(index=False), 200, headers
+    return payload_response(payload, headers)
+
+
+@app.route('/api/v1/metrics')
+def show_metrics():
+    return metrics.render(manager.get_gauges()), 200, {
+        'Content-Type': 'text/plain; version=0.0.4; charset=utf-8',
+        'Cache-Control': 'no-store',
+    }
+
+
+@app.route('/api/v1/profiles/<string:region>')
+def show_profile(region):
+    key = get_job_key(region, request.args.get('metric', get_metric()))
+    if not is_profiling_enabled() or key not in manager.profiles:
+        return '', 404, {'Cache-Control': 'no-store'}
+
+    return manager.profiles[key], 200, {
+        'Content-Type': 'text/plain; charset=utf-8',
+        'Cache-Control': 'no-store',
+    }
 
 
 @app.route('/api/v1/regions/<string:region>')
 def show_region(region):
-    df, is_up_to_date = manager.get_region(region)
+    # ?metric=dtw compares timelines with dynamic time warping instead of
+    # the default metric
+    metric = request.args.get('metric', get_metric())
+    if metric not in METRICS:
+        return '', 400, {'Cache-Control': 'no-store'}
+
+    # ?profile=1 captures a cProfile report of a fresh job for the region
+    if is_profiling_enabled() and request.args.get('profile') == '1' and manager.is_ready():
+        manager.profile_region(region, metric)
 
-    if df is None:
+    payload, is_up_to_date = manager.get_region(region, get_media_type(), metric)
+
+    if payload is None:
         return '', 202, {'Cache-Control': 'no-store'}
 
-    headers = {
-        'Content-Type': 'text/plain; charset=UTF-8',
-    }
+    headers = {}
 
     if is_up_to_date and manager.is_cacheable():
         headers['Cache-Control'] = 'public, max-age=86400'
 
-    return df.to_csv(index=False), 200, headers
+    return payload_response(payload, headers)
@@ -0,0 +1,140 @@
+from os import getenv, makedirs, path
+import json
+
+import numpy as np
+import pandas as pd
+
+from percy.clusters import DISTANCE_COLUMNS
+
+PAIR_DTYPE = np.dtype([
+    ('a', np.int32),
+    ('b', np.int32),
+    ('distances', np.float32, (len(DISTANCE_COLUMNS),)),
+])
+
+
+def get_by_key_batch_size():
+    # pairs gathered in memory at once while writing by_key files
+    return int(getenv('SIMILARITY_BY_KEY_BATCH', 2 ** 20))
+
+
+class PairShards(object):
+    # Pairs of regions written to disk as they are computed, one shard per
+    # call to `append`: int32 indices into `keys` and float32 distances in
+    # one record array, plus a bit-packed same-cluster flag. Shards are
+    # memory-mapped when read back, so no step holds the whole table.
+    def __init__(self, directory, keys, counts=None):
+        self.directory = directory
+        self.keys = list(keys)
+        self.counts = [] if counts is None else list(counts)
+
+    def __len__(self):
+        return sum(self.counts)
+
+    @classmethod
+    def create(cls, directory, keys):
+        makedirs(directory, exist_ok=True)
+        shards = cls(directory, keys)
+        shards.flush()
+        return shards
+
+    @classmethod
+    def load(cls, directory):
+        with open(path.join(directory, 'shards.json')) as f:
+            info = json.load(f)
+        return cls(directory, info['keys'], info['counts'])
+
+    def flush(self):
+        with open(path.join(self.directory, 'shards.json'), 'w') as f:
+            json.dump({'keys': self.keys, 'counts': self.counts}, f)
+
+    def append(self, a_rows, b_rows, distances, is_same_cluster):
+        count = len(a_rows)
+        if count == 0:
+            return
+
+        pairs = np.empty(count, dtype=PAIR_DTYPE)
+        pairs['a'] = a_rows
+        pairs['b'] = b_rows
+        pairs['distances'] = distances
+
+        shard = len(self.counts)
+        np.save(self._filename(shard, 'pairs'), pairs)
+        np.save(self._filename(shard, 'same'), np.packbits(np.asarray(is_same_cluster, dtype=bool)))
+        self.counts.append(count)
+
+    def shard(self, shard):
+        pairs = np.load(self._filename(shard, 'pairs'), mmap_mode='r')
+        is_same_cluster = np.unpackbits(np.load(self._filename(shard, 'same')), count=len(pairs)).astype(bool)
+        return pairs['a'], pairs['b'], pairs['distances'], is_same_cluster
+
+    def iter_shards(self, start=0):
+        for shard in range(start, len(self.counts)):
+            yield self.shard(shard)
+
+    def degrees(self):
+        degrees = np.zeros(len(self.keys), dtype=np.int64)
+        for a_rows, b_rows, _, _ in self.iter_shards():
+            degrees += np.bincount(a_rows, minlength=len(self.keys))
+            degrees += np.bincount(b_rows, minlength=len(self.keys))
+        return degrees
+
+    def endpoints(self, rows, start=0):
+        # Regions paired with any of `rows` (a boolean mask over `keys`) in
+        # the shards from `start` on, including those rows themselves.
+        affected = np.zeros(len(self.keys), dtype=bool)
+        for a_rows, b_rows, _, _ in self.iter_shards(start):
+            touched = rows[a_rows] | rows[b_rows]
+            affected[a_rows[touched]] = True
+            affected[b_rows[touched]] = True
+        return affected
+
+    def copy_to(self, shards, exclude):
+        # Appends the pairs that do not involve any of the `exclude` keys to
+        # `shards`, translated to its own keys.
+        rows = {key: row for row, key in enumerate(shards.keys)}
+        remap = np.array([rows.get(key, -1) for key in self.keys], dtype=np.int64)
+        excluded = pd.Index(self.keys).isin(list(exclude))
+
+        for a_rows, b_rows, distances, is_same_cluster in self.iter_shards():
+            kept = ~(excluded[a_rows] | excluded[b_rows]) & (remap[a_rows] >= 0) & (remap[b_rows] >= 0)
+            shards.append(remap[a_rows[kept]], remap[b_rows[kept]], distances[kept], is_same_cluster[kept])
+
+    def iter_region_frames(self, regions, batch_size=None):
+        # The pairs of each region seen from that region, in shard order.
+        # Regions are handled in batches of about `batch_size` pairs, each
+        # batch reading every shard once.
+        if batch_size is None:
+            batch_size = get_by_key_batch_size()
+
+        keys = np.array(self.keys, dtype=object)
+        degrees = self.degrees()
+        rows = np.flatnonzero(pd.Index(self.keys).isin(list(regions)) & (degrees > 0))
+        batches = (np.cumsum(degrees[rows]) - degrees[rows]) // max(batch_size, 1)
+        offsets = np.cumsum([0] + self.counts)
+
+        for batch in np.unique(batches):
+            in_batch = np.zeros(len(keys), dtype=bool)
+            in_batch[rows[batches == batch]] = True
+
+            parts = []
+            for shard, (a_rows, b_rows, distances, is_same_cluster) in enumerate(self.iter_shards()):
+                for owners, others in [(a_rows, b_rows), (b_rows, a_rows)]:
+                    selected = np.flatnonzero(in_batch[owners])
+                    parts.append((owners[selected], others[selected], offsets[shard] + selected, distances[selected], is_same_cluster[selected]))
+
+            owners, others, pair_rows, distances, is_same_cluster = (np.concatenate(part) for part in zip(*parts))
+            order = np.lexsort((pair_rows, owners))
+            owners, others, distances, is_same_cluster = owners[order], others[order], distances[order], is_same_cluster[order]
+
+            starts = np.flatnonzero(np.diff(owners, prepend=-1))
+            stops = np.append(starts[1:], len(owners))
+            for start, stop in zip(starts, stops):
+                region_df = pd.DataFrame({'region': keys[others[start:stop]]})
+                for i, column in enumerate(DISTANCE_COLUMNS):
+                    region_df[column] = distances[start:stop, i]
+                region_df['is_same_cluster'] = is_same_cluster[start:stop]
+                yield keys[owners[start]], region_df
+
+    def _filename(self, shard, name):
+        return path.join(self.directory, f'{shard:06d}.{name}.npy')
@@ -1,78 +1,153 @@
-from os import path
+from os import path, getenv, makedirs, rename
+import shutil
+from functools import partial
+import sys
 import json
+import multiprocessing as mp
 import pandas as pd
 import numpy as np
-import multiprocessing as mp
 
 from sklearn import preprocessing
 from sklearn.preprocessing import MinMaxScaler
 from sklearn.metrics.pairwise import cosine_similarity
 
-from percy.clusters import process, per_similarity, per_timeline
-
-TOP_K = 100
-
-
-def get_top_k_target(df, attr):
-    return df[attr].sort_values(ascending=True).iloc[min(TOP_K, len(df))-1]
+from percy.clusters import DISTANCE_COLUMNS, METRICS, TOP_K, get_metric, get_output_name, get_top_k_mask, process, process_with_days, per_similarity
+from percy.common import metadata_changed
+from percy.incremental import compute_watermarks, get_changed_regions, load_watermarks, save_watermarks
+from percy.neighbors import NeighborIndex, get_neighbors_dir
+from percy.pairs import get_processes, per_timeline_shards
+from percy.shards import PairShards
+from percy.storage import read_frame, write_frame
 
+SIMILARITY_DATA = 'inf-covid19-similarity-data'
+CACHE_DIR = getenv('SIMILARITY_CACHE_DIR', 'cache')
 
-def similarity_worker(args):
-    metadata, df, offset = args
-    return per_timeline(metadata, df, offset)
 
+def save_region(task, directory='by_key'):
+    region, region_df = task
+    within_top_k = get_top_k_mask(region_df[DISTANCE_COLUMNS].to_numpy(), TOP_K)
+    within_same_cluster = region_df['is_same_cluster'] == True
+    region_df = region_df[within_top_k | within_same_cluster]
+    write_frame(region_df, path.join(SIMILARITY_DATA, directory, region))
+    return region, region_df['region'].tolist()
 
-if __name__ == "__main__":
-    print('Loading metadata...')
-    metadata = {}
-    with open(path.join('inf-covid19-data', 'data', 'metadata.json')) as f:
-        metadata = json.load(f)
 
-    # process atributes
-    print('Processing attributes...')
-    df_attributes = process(metadata)
-    print(f'  Found {len(df_attributes)} regions.')
+def save_by_key(pairs, regions, processes=None, directory='by_key', neighbors=None):
+    # With a NeighborIndex, records the regions listed in every output.
+    if processes is None:
+        processes = get_processes()
 
-    # clustering by attributes
-    print('Clustering by attributes...')
-    clusters = per_similarity(df_attributes)
-    df_attributes['cluster'] = clusters.labels_
+    makedirs(path.join(SIMILARITY_DATA, directory), exist_ok=True)
+    save = partial(save_region, directory=directory)
 
-    df_attributes = df_attributes.sort_values(by=['cluster', 'key'])
+    tasks = pairs.iter_region_frames(regions)
+    if processes <= 1:
+        record_neighbors(map(save, tasks), neighbors)
+        return
 
-    df_attributes.to_csv(path.join('inf-covid19-similarity-data', 'regions.csv'), index=False)
+    with mp.Pool(processes=processes) as pool:
+        record_neighbors(pool.imap_unordered(save, tasks, chunksize=16), neighbors)
 
-    clusters = df_attributes['cluster'].unique()
-    print(f'  Found {len(clusters)} clusters.')
 
-    # similarity by timeline
-    print('Calculating similarity by timeline...')
+def record_neighbors(results, neighbors, batch_size=256):
+    outputs = {}
+    for region, listed in results:
+        if neighbors is None:
+            continue
 
-    df_similarities = None
-    with mp.Pool(processes=3) as pool:
-        dfs = pool.map(similarity_worker, ((metadata, df_attributes, offset) for offset in range(0, len(df_attributes), 500)))
-        df_similarities = pd.concat(dfs, ignore_index=True)
+        outputs[region] = listed
+        if len(outputs) >= batch_size:
+            neighbors.update(outputs)
+            outputs = {}
 
-    # save each region
-    print('Saving output file for each region...')
-    for region in df_attributes['key']:
-        is_a = df_similarities['region_a'] == region
-        is_b = df_similarities['region_b'] == region
-        region_df = df_similarities[is_a | is_b].copy()
+    if neighbors is not None:
+        neighbors.update(outputs)
 
-        if len(region_df) == 0:
-            continue
 
-        region_df['region'] = region_df.apply(lambda r: r['region_b'] if r['region_a'] == region else r['region_a'], axis=1)
+if __name__ == "__main__":
+    # --metric dtw writes by_key_dtw/ and keeps its own pairs
+    metric = sys.argv[sys.argv.index('--metric') + 1] if '--metric' in sys.argv else get_metric()
+    if metric not in METRICS:
+        sys.exit(f'Unknown metric {metric}, expected one of {", ".join(METRICS)}.')
 
-        region_df = region_df[['region', 'cases_distance', 'deaths_distance', 'cases_per_100k_distance', 'deaths_per_100k_distance', 'is_same_cluster']]
+    regions_file = path.join(SIMILARITY_DATA, 'regions')
+    watermarks_file = path.join(SIMILARITY_DATA, f'{get_output_name("watermarks", metric)}.csv')
+    pairs_dir = path.join(CACHE_DIR, get_output_name('pairs', metric))
+    partial_pairs_dir = f'{pairs_dir}.partial'
 
-        within_cases_top_k = region_df['cases_distance'] <= get_top_k_target(region_df, 'cases_distance')
-        within_deaths_top_k = region_df['deaths_distance'] <= get_top_k_target(region_df, 'deaths_distance')
-        within_cases_per_100k_top_k = region_df['cases_per_100k_distance'] <= get_top_k_target(region_df, 'cases_per_100k_distance')
-        within_deaths_per_100k_top_k = region_df['deaths_per_100k_distance'] <= get_top_k_target(region_df, 'deaths_per_100k_distance')
+    print('Loading metadata...')
+    metadata = {}
+    with open(path.join('inf-covid19-data', 'data', 'metadata.json')) as f:
+        metadata = json.load(f)
 
-        within_top_k = within_cases_top_k | within_deaths_top_k | within_cases_per_100k_top_k | within_deaths_per_100k_top_k 
-        within_same_cluster = region_df['is_same_cluster'] == True
-        region_df[within_top_k | within_same_cluster].to_csv(path.join('inf-covid19-similarity-data', 'by_key', f'{region}.csv'), index=False)
+    is_metadata_changed = metadata_changed()
+    # pairs left out by the dtw lower bounds may enter the top k of a region
+    # once its neighbors change, so dtw runs always start over
+    is_incremental = '--incremental' in sys.argv and not is_metadata_changed and metric == 'manhattan' and \
+        all(path.isfile(filename) for filename in [f'{regions_file}.csv', watermarks_file, path.join(pairs_dir, 'shards.json')])
+
+    if is_incremental:
+        # only the regions whose timeline changed since the last run are
+        # compared again, and only the files that include them are rewritten
+        print('Loading attributes...')
+        df_attributes = read_frame(regions_file)
+
+        print('Looking for changed regions...')
+        changed, watermarks = get_changed_regions(metadata, df_attributes, load_watermarks(watermarks_file))
+        print(f'  Found {len(changed)} changed regions.')
+
+        df_attributes = process_with_days(metadata, df_attributes, changed)
+        write_frame(df_attributes, regions_file)
+
+        print('Calculating similarity by timeline...')
+        previous = PairShards.load(pairs_dir)
+        keys = df_attributes['key'].tolist()
+        shutil.rmtree(partial_pairs_dir, ignore_errors=True)
+        pairs = PairShards.create(partial_pairs_dir, keys)
+        previous.copy_to(pairs, exclude=changed)
+        start = len(pairs.counts)
+
+        dirty = df_attributes['key'].isin(changed).to_numpy()
+        if dirty.any():
+            per_timeline_shards(metadata, df_attributes, pairs, dirty=dirty, metric=metric)
+        pairs.flush()
+
+        affected = set(np.array(previous.keys, dtype=object)[previous.endpoints(pd.Index(previous.keys).isin(changed))])
+        affected.update(np.array(keys, dtype=object)[pairs.endpoints(np.ones(len(keys), dtype=bool), start)])
+        regions = df_attributes.loc[df_attributes['key'].isin(affected), 'key']
+    else:
+        # process atributes
+        print('Processing attributes...')
+        df_attributes = process(metadata)
+        print(f'  Found {len(df_attributes)} regions.')
+
+        # clustering by attributes
+        print('Clustering by attributes...')
+        clusters = per_similarity(df_attributes)
+        df_attributes['cluster'] = clusters.labels_
+
+        df_attributes = df_attributes.sort_values(by=['cluster', 'key'])
+
+        write_frame(df_attributes, regions_file)
+
+        clusters = df_attributes['cluster'].unique()
+        print(f'  Found {len(clusters)} clusters.')
+
+        # similarity by timeline
+        print('Calculating similarity by timeline...')
+
+        keys = df_attributes['key'].tolist()
+        shutil.rmtree(partial_pairs_dir, ignore_errors=True)
+        pairs = per_timeline_shards(metadata, df_attributes, PairShards.create(partial_pairs_dir, keys), metric=metric)
+
+        watermarks = compute_watermarks(metadata, df_attributes)
+        regions = df_attributes['key']
+
+    save_watermarks(watermarks, watermarks_file)
+    shutil.rmtree(pairs_dir, ignore_errors=True)
+    rename(partial_pairs_dir, pairs_dir)
+    pairs = PairShards.load(pairs_dir)
 
+    # save each region
+    print(f'Saving output file for {len(regions)} regions...')
+    save_by_key(pairs, regions, directory=get_output_name('by_key', metric), neighbors=NeighborIndex(get_neighbors_dir(metric)))
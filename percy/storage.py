@@ -0,0 +1,137 @@
+from os import getenv, makedirs, path
+import io
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+CSV_MEDIA_TYPE = 'text/plain'
+ARROW_STREAM_MEDIA_TYPE = 'application/vnd.apache.arrow.stream'
+PARQUET_MEDIA_TYPE = 'application/vnd.apache.parquet'
+
+EXTENSIONS = {
+    'parquet': '.parquet',
+    'npz': '.npz',
+}
+
+# NumPy archives keep the missing values of text columns in a mask stored
+# next to the column, under its name with this suffix.
+MISSING_SUFFIX = '.missing'
+
+
+def get_storage_format():
+    # Binary format of the copies read_frame keeps of CSV outputs. Parquet
+    # needs pyarrow; without it the NumPy archive is used.
+    default = 'parquet' if pq is not None else 'npz'
+    storage_format = getenv('SIMILARITY_STORAGE_FORMAT', default)
+    if storage_format == 'parquet' and pq is None:
+        return 'npz'
+    return storage_format
+
+
+def get_frames_dir():
+    return path.join(getenv('SIMILARITY_CACHE_DIR', 'cache'), 'frames')
+
+
+def get_binary_filename(filename, storage_format):
+    # binary copies are kept out of the published repositories, under the
+    # same relative path as their CSV
+    return path.join(get_frames_dir(), f'{filename.lstrip(path.sep)}{EXTENSIONS[storage_format]}')
+
+
+def get_media_types():
+    media_types = [CSV_MEDIA_TYPE]
+    if pa is not None:
+        media_types += [ARROW_STREAM_MEDIA_TYPE, PARQUET_MEDIA_TYPE]
+    return media_types
+
+
+def write_frame(df, filename):
+    # `filename` has no extension: the CSV and the binary copy read_frame
+    # makes of it share it.
+    df.to_csv(f'{filename}.csv', index=False)
+
+
+def write_binary_frame(df, filename):
+    storage_format = get_storage_format()
+    if storage_format not in EXTENSIONS:
+        return
+
+    binary_filename = get_binary_filename(filename, storage_format)
+    makedirs(path.dirname(binary_filename), exist_ok=True)
+    if storage_format == 'parquet':
+        df.to_parquet(binary_filename, index=False)
+    elif storage_format == 'npz':
+        arrays = {}
+        for column in df.columns:
+            arrays.update(to_numpy_columns(column, df[column]))
+        np.savez(binary_filename, **arrays)
+
+
+def read_frame(filename):
+    # The binary copy is used when it is at least as recent as the CSV, and
+    # is made from the CSV the first time it is read otherwise, so outputs
+    # that are never read again are only written once.
+    csv_filename = f'{filename}.csv'
+    storage_format = get_storage_format()
+    binary_filename = get_binary_filename(filename, storage_format) if storage_format in EXTENSIONS else None
+
+    if binary_filename is not None and path.isfile(binary_filename) and \
+            (not path.isfile(csv_filename) or path.getmtime(binary_filename) >= path.getmtime(csv_filename)):
+        if storage_format == 'parquet':
+            return pd.read_parquet(binary_filename)
+        with np.load(binary_filename, allow_pickle=False) as data:
+            columns = [column for column in data.files if not column.endswith(MISSING_SUFFIX)]
+            return pd.DataFrame({column: from_numpy_columns(column, data) for column in columns})
+
+    df = pd.read_csv(csv_filename)
+    if binary_filename is not None:
+        write_binary_frame(df, filename)
+    return df
+
+
+def to_numpy_columns(column, series):
+    # text columns are saved as fixed-width strings, which cannot hold
+    # missing values
+    if series.dtype == object or pd.api.types.is_string_dtype(series.dtype):
+        missing = series.isna().to_numpy()
+        values = series.where(~missing, '').astype(str).to_numpy(dtype=str)
+        return {column: values, f'{column}{MISSING_SUFFIX}': missing}
+    return {column: series.to_numpy()}
+
+
+def from_numpy_columns(column, data):
+    values = data[column]
+    mask = f'{column}{MISSING_SUFFIX}'
+    if mask in data.files:
+        values = values.astype(object)
+        values[data[mask]] = np.nan
+    return values
+
+
+def to_arrow_stream(df):
+    sink = io.BytesIO()
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue()
+
+
+def to_parquet(df):
+    sink = io.BytesIO()
+    df.to_parquet(sink, index=False)
+    return sink.getvalue()
+
+
+def serialize_frame(df, media_type):
+    if media_type == ARROW_STREAM_MEDIA_TYPE:
+        return to_arrow_stream(df)
+    if media_type == PARQUET_MEDIA_TYPE:
+        return to_parquet(df)
+    return df.to_csv(index=False).encode('utf-8')
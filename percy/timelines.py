@@ -0,0 +1,380 @@
+from functools import wraps
+import json
+from os import path, stat
+import threading as th
+
+import numpy as np
+import pandas as pd
+
+from percy.utils import checksum
+
+TIMELINE_FEATURES = ['cases', 'cases_daily', 'deaths', 'deaths_daily', 'cases_per_100k', 'deaths_per_100k']
+
+
+def feature_columns(features):
+    return [TIMELINE_FEATURES.index(feature) for feature in features]
+
+
+def synchronized(method):
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class TimelineStore(object):
+    # All timelines live in one (regions x days x features) array. Days are
+    # aligned on a global date axis starting at `origin`, and each region
+    # occupies `lengths[row]` days starting at `offsets[row]`.
+    #
+    # With a byte `budget`, `evict` drops the least recently used regions
+    # once the live rows exceed it; callers run it after they are done with
+    # the timelines of a batch. Regions loaded from a tracked source file are
+    # dropped as soon as the file content changes.
+    #
+    # `update` may reallocate `values` and shift `offsets`, so methods run
+    # under `lock`, and callers reading the arrays directly across several
+    # steps hold it too.
+    def __init__(self, dtype=np.float64, features=TIMELINE_FEATURES, budget=None):
+        self.lock = th.RLock()
+        self.dtype = np.dtype(dtype)
+        self.features = list(features)
+        self.budget = budget or None
+        self._reset()
+
+    def _reset(self):
+        self.origin = None
+        self.values = np.zeros((0, 0, len(self.features)), dtype=self.dtype)
+        self.offsets = np.zeros(0, dtype=np.int64)
+        self.lengths = np.zeros(0, dtype=np.int64)
+        self.last_used = np.zeros(0, dtype=np.int64)
+        self.index = {}
+        self.free_rows = []
+        self.sources = {}
+        self.tick = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return self.index.keys()
+
+    @synchronized
+    def row(self, key):
+        row = self.index[key]
+        self._touch(row)
+        return row
+
+    @synchronized
+    def rows(self, keys):
+        rows = np.fromiter((self.index[key] for key in keys), dtype=np.int64, count=len(keys))
+        self._touch(rows)
+        return rows
+
+    @synchronized
+    def lookup(self, keys):
+        missing = [key for key in keys if key not in self.index]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        return missing
+
+    def columns(self, features):
+        return np.array([self.features.index(feature) for feature in features])
+
+    @synchronized
+    def length(self, key):
+        return self.lengths[self.index[key]]
+
+    @synchronized
+    def view(self, key):
+        row = self.row(key)
+        offset = self.offsets[row]
+        return self.values[row, offset:offset + self.lengths[row]]
+
+    @synchronized
+    def get(self, key):
+        row = self.row(key)
+        length = self.lengths[row]
+        if length == 0:
+            return pd.DataFrame()
+
+        df = pd.DataFrame(self.view(key), columns=self.features)
+        dates = self.origin + np.arange(self.offsets[row], self.offsets[row] + length).astype('timedelta64[D]')
+        df.insert(0, 'date', pd.to_datetime(dates))
+        return df
+
+    @synchronized
+    def update(self, timelines):
+        if len(timelines) == 0:
+            return
+
+        first_dates = [
+            df['date'].iloc[0].to_datetime64().astype('datetime64[D]')
+            for df in timelines.values() if len(df) > 0
+        ]
+        if len(first_dates) > 0:
+            self._rebase(min(first_dates))
+
+        placements = {}
+        width = self.values.shape[1]
+        for key, df in timelines.items():
+            offset = 0
+            if len(df) > 0:
+                offset = int((df['date'].iloc[0].to_datetime64().astype('datetime64[D]') - self.origin).astype(int))
+            placements[key] = (offset, len(df))
+            width = max(width, offset + len(df))
+
+        new_keys = [key for key in timelines if key not in self.index]
+        self._reserve(len(new_keys) - len(self.free_rows), width)
+
+        for key in new_keys:
+            self.index[key] = self.free_rows.pop()
+
+        for key, df in timelines.items():
+            row = self.row(key)
+            offset, length = placements[key]
+            self.values[row] = 0
+            self.offsets[row] = offset
+            self.lengths[row] = length
+            if length > 0:
+                self.values[row, offset:offset + length] = df[self.features].to_numpy(dtype=self.dtype)
+
+    @synchronized
+    def discard(self, keys):
+        for key in keys:
+            row = self.index.pop(key, None)
+            if row is None:
+                continue
+            self.values[row] = 0
+            self.offsets[row] = 0
+            self.lengths[row] = 0
+            self.last_used[row] = 0
+            self.free_rows.append(row)
+
+    @synchronized
+    def clear(self):
+        self._reset()
+
+    @synchronized
+    def track(self, filename, digest, keys):
+        try:
+            signature = self._signature(filename) if filename is not None else None
+        except OSError:
+            signature = None
+
+        _, _, tracked_keys = self.sources.get(filename, (None, None, set()))
+        self.sources[filename] = (signature, digest, tracked_keys | set(keys))
+
+    @synchronized
+    def refresh(self):
+        # Drops the regions of every tracked file whose content changed. The
+        # checksum is only recomputed when the file size or mtime moved.
+        for filename, (signature, digest, keys) in list(self.sources.items()):
+            if filename is None:
+                # regions without a source file
+                del self.sources[filename]
+                self.discard(keys)
+                continue
+
+            try:
+                current_signature = self._signature(filename)
+                current_digest = checksum(filename) if current_signature != signature else digest
+            except OSError:
+                current_signature, current_digest = None, None
+
+            if current_digest == digest:
+                self.sources[filename] = (current_signature, digest, keys)
+                continue
+
+            del self.sources[filename]
+            self.discard(keys)
+
+    @synchronized
+    def evict(self, keep=()):
+        if self.budget is None or self.nbytes <= self.budget:
+            return
+
+        keep = set(self.index[key] for key in keep if key in self.index)
+        rows = np.array([row for row in self.index.values() if row not in keep], dtype=np.int64)
+        if len(rows) == 0:
+            return
+
+        excess = int(np.ceil((self.nbytes - self.budget) / self.row_nbytes))
+        evicted = set(rows[np.argsort(self.last_used[rows], kind='stable')[:excess]].tolist())
+        self.discard([key for key, row in self.index.items() if row in evicted])
+        self.evictions += len(evicted)
+
+        if len(self.free_rows) > len(self.index):
+            self._shrink()
+
+    @property
+    def row_nbytes(self):
+        return self.values.shape[1] * len(self.features) * self.dtype.itemsize
+
+    @property
+    def nbytes(self):
+        return len(self.index) * self.row_nbytes
+
+    @synchronized
+    def stats(self):
+        return {
+            'regions': len(self.index),
+            'bytes': self.nbytes,
+            'allocated_bytes': self.values.nbytes,
+            'budget_bytes': self.budget,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    @synchronized
+    def compact(self, keys, features=None):
+        # Copy of the given regions, in order, trimmed to the used date range.
+        features = self.features if features is None else list(features)
+        store = TimelineStore(self.dtype, features)
+        rows = self.rows(keys)
+        if len(rows) == 0:
+            return store
+
+        lengths = self.lengths[rows]
+        offsets = self.offsets[rows]
+        used = lengths > 0
+        first = offsets[used].min() if used.any() else 0
+        last = (offsets + lengths)[used].max() if used.any() else 0
+
+        store.values = np.ascontiguousarray(self.values[rows, first:last][:, :, self.columns(features)])
+        store.offsets = np.where(used, offsets - first, 0)
+        store.lengths = lengths.copy()
+        store.last_used = np.zeros(len(keys), dtype=np.int64)
+        store.index = {key: row for row, key in enumerate(keys)}
+        if self.origin is not None:
+            store.origin = self.origin + np.timedelta64(int(first), 'D')
+        return store
+
+    def save(self, directory):
+        np.save(path.join(directory, 'values.npy'), self.values)
+        self._save_rows(directory)
+
+    def _save_rows(self, directory):
+        np.save(path.join(directory, 'offsets.npy'), self.offsets)
+        np.save(path.join(directory, 'lengths.npy'), self.lengths)
+        with open(path.join(directory, 'store.json'), 'w') as f:
+            json.dump({
+                'dtype': self.dtype.str,
+                'features': self.features,
+                'origin': None if self.origin is None else str(self.origin),
+                'index': self.index,
+                'free_rows': self.free_rows,
+            }, f)
+
+    @classmethod
+    def load(cls, directory, mmap_mode=None):
+        with open(path.join(directory, 'store.json')) as f:
+            info = json.load(f)
+
+        store = cls(info['dtype'], info['features'])
+        store.values = np.load(path.join(directory, 'values.npy'), mmap_mode=mmap_mode)
+        store.offsets = np.load(path.join(directory, 'offsets.npy'))
+        store.lengths = np.load(path.join(directory, 'lengths.npy'))
+        store.last_used = np.zeros(len(store.lengths), dtype=np.int64)
+        store.index = info['index']
+        store.free_rows = info['free_rows']
+        if info['origin'] is not None:
+            store.origin = np.datetime64(info['origin'], 'D')
+        return store
+
+    @classmethod
+    def concat(cls, directories, directory, keys=None):
+        # Saves the regions of the stores saved in `directories` as one store
+        # in `directory`, in the order of `keys` (by default, store by store).
+        # The stores are copied one at a time into a memory-mapped array, so
+        # they are never all in memory.
+        stores = [cls.load(source, mmap_mode='r') for source in directories]
+        if keys is None:
+            keys = [key for source in stores for key in source.index]
+
+        store = cls(stores[0].dtype, stores[0].features) if len(stores) > 0 else cls()
+        origins = [source.origin for source in stores if source.origin is not None]
+        store.origin = min(origins) if len(origins) > 0 else None
+        shifts = [0 if source.origin is None else int((source.origin - store.origin).astype(int)) for source in stores]
+        width = max([shift + source.values.shape[1] for shift, source in zip(shifts, stores)], default=0)
+
+        shape = (len(keys), width, len(store.features))
+        store.values = np.lib.format.open_memmap(path.join(directory, 'values.npy'), mode='w+', dtype=store.dtype, shape=shape)
+        store.offsets = np.zeros(len(keys), dtype=np.int64)
+        store.lengths = np.zeros(len(keys), dtype=np.int64)
+        store.last_used = np.zeros(len(keys), dtype=np.int64)
+        store.index = {key: row for row, key in enumerate(keys)}
+
+        for shift, source in zip(shifts, stores):
+            source_keys = [key for key in source.index if key in store.index]
+            rows = source.rows(source_keys)
+            targets = store.rows(source_keys)
+            lengths = source.lengths[rows]
+            store.values[targets, shift:shift + source.values.shape[1]] = source.values[rows]
+            store.offsets[targets] = np.where(lengths > 0, source.offsets[rows] + shift, 0)
+            store.lengths[targets] = lengths
+
+        store.values.flush()
+        store._save_rows(directory)
+        return store
+
+    def _touch(self, rows):
+        self.tick += 1
+        self.last_used[rows] = self.tick
+
+    def _signature(self, filename):
+        info = stat(filename)
+        return info.st_mtime_ns, info.st_size
+
+    def _shrink(self):
+        keys = list(self.index.keys())
+        rows = np.fromiter(self.index.values(), dtype=np.int64, count=len(keys))
+
+        self.values = self.values[rows]
+        self.offsets = self.offsets[rows]
+        self.lengths = self.lengths[rows]
+        self.last_used = self.last_used[rows]
+        self.index = {key: row for row, key in enumerate(keys)}
+        self.free_rows = []
+
+    def _rebase(self, origin):
+        if self.origin is None:
+            self.origin = origin
+            return
+
+        shift = int((self.origin - origin).astype(int))
+        if shift <= 0:
+            return
+
+        capacity, width, features = self.values.shape
+        values = np.zeros((capacity, width + shift, features), dtype=self.dtype)
+        values[:, shift:] = self.values
+        self.values = values
+        self.offsets += shift
+        self.origin = origin
+
+    def _reserve(self, rows, width):
+        capacity, current_width, features = self.values.shape
+        rows = max(0, rows)
+        if rows == 0 and width <= current_width:
+            return
+
+        new_capacity = capacity
+        if rows > 0:
+            new_capacity = max(capacity + rows, capacity * 2)
+        values = np.zeros((new_capacity, max(width, current_width), features), dtype=self.dtype)
+        values[:capacity, :current_width] = self.values
+        self.values = values
+
+        self.offsets = np.concatenate([self.offsets, np.zeros(new_capacity - capacity, dtype=np.int64)])
+        self.lengths = np.concatenate([self.lengths, np.zeros(new_capacity - capacity, dtype=np.int64)])
+        self.last_used = np.concatenate([self.last_used, np.zeros(new_capacity - capacity, dtype=np.int64)])
+        self.free_rows.extend(range(new_capacity - 1, capacity - 1, -1))
@@ -1,56 +1,67 @@
+import numpy as np
 import pandas as pd
 from os import path, getcwd
-from fnc.sequences import groupby
 
-from percy.common import make_attributes
+from percy.common import get_subregion_keys, make_attributes
+from percy.references import load_reference
 
+ATTRIBUTE_COLUMNS = ['state', 'county', 'place_type', 'fips']
 
-def get_fips(state, county=0):
-    state_part = str(int(state)).rjust(2, '0')
-    county_part = str(int(county)).rjust(3, '0')
-    return int(f'{state_part}{county_part}')
+AREA_BY_FIPS_FILE = path.join('raw', 'united_states_of_america', 'DataSet.csv')
+POPULATION_BY_FIPS_FILE = path.join('raw', 'united_states_of_america', 'co-est2019-alldata.csv')
 
 
-def process_united_states_of_america(key, metadata):
-    key_list = []
-    population_list = []
-    area_km_list = []
+def get_fips(state, county=0):
+    # works on scalars as well as on whole columns
+    return np.multiply(state, 1000).astype(np.int64) + np.asarray(county).astype(np.int64)
 
-    area_by_fips = pd.read_csv(path.join('raw', 'united_states_of_america', 'DataSet.csv'))[['fips', 'LND110210']].set_index('fips')
+
+def read_area_by_fips():
+    df = pd.read_csv(AREA_BY_FIPS_FILE, usecols=['fips', 'LND110210'])
 
     # convert to square km
-    area_by_fips['LND110210'] *= 2.59
+    return df.set_index('fips')['LND110210'] * 2.59
 
-    pop_by_fips = pd.read_csv(path.join('raw', 'united_states_of_america', 'co-est2019-alldata.csv'), encoding='ISO-8859-1')[['STATE', 'COUNTY', 'POPESTIMATE2019']]
-    pop_by_fips['FIPS'] = pop_by_fips.apply(lambda r: get_fips(r['STATE'], r['COUNTY']), axis=1)
-    pop_by_fips = pop_by_fips[['FIPS', 'POPESTIMATE2019']].set_index("FIPS")
 
-    parent_regions = [x for x in metadata['regions'].items() if 'parent' not in x[1]]
-    regions_by_parent = groupby([1, 'parent'], metadata['regions'].items())
+def read_population_by_fips():
+    df = pd.read_csv(POPULATION_BY_FIPS_FILE, encoding='ISO-8859-1', usecols=['STATE', 'COUNTY', 'POPESTIMATE2019'])
+    return df.set_index(get_fips(df['STATE'], df['COUNTY']))['POPESTIMATE2019']
 
-    for region_key, data in parent_regions:
-        df = pd.read_csv(path.join('inf-covid19-data', data['file']), parse_dates=False)
-        df = df[['state', 'county', 'place_type', 'fips']].drop_duplicates()
-        for _, row in df.iterrows():
-            fips = row['fips']
-            place_type = row['place_type']
 
-            if place_type == 'state':
-                fips = get_fips(fips)
+def get_area_by_fips():
+    return load_reference('usa_area_by_fips', [AREA_BY_FIPS_FILE], read_area_by_fips)
 
-            if fips not in pop_by_fips.index or fips not in area_by_fips.index:
-                continue
 
-            area_km = area_by_fips.loc[fips]['LND110210']
-            population = pop_by_fips.loc[fips]['POPESTIMATE2019']
+def get_population_by_fips():
+    return load_reference('usa_population_by_fips', [POPULATION_BY_FIPS_FILE], read_population_by_fips)
 
-            composed_key = f'{key}.regions.{region_key}'
-            if place_type == 'county':
-                [subregion_key] = [x[0] for x in regions_by_parent[region_key] if x[1]['name'] == row['county']]
-                composed_key = f'{key}.regions.{subregion_key}'
 
-            key_list.append(composed_key)
-            population_list.append(population)
-            area_km_list.append(area_km)
+def process_united_states_of_america(key, metadata):
+    area_by_fips = get_area_by_fips()
+    pop_by_fips = get_population_by_fips()
 
-    return make_attributes(key_list, population_list, area_km_list)
\ No newline at end of file
+    parent_regions = [x for x in metadata['regions'].items() if 'parent' not in x[1]]
+    subregion_keys = get_subregion_keys(metadata)
+
+    attributes = []
+    for region_key, data in parent_regions:
+        df = pd.read_csv(path.join('inf-covid19-data', data['file']), usecols=ATTRIBUTE_COLUMNS, parse_dates=False)
+        df = df[ATTRIBUTE_COLUMNS].drop_duplicates()
+
+        is_state = df['place_type'] == 'state'
+        fips = df['fips'].copy()
+        fips[is_state] = get_fips(fips[is_state])
+
+        subregion_key = df['county'].map(subregion_keys.get(region_key, {}))
+        composed_key = (f'{key}.regions.' + subregion_key).where(df['place_type'] == 'county', f'{key}.regions.{region_key}')
+
+        is_valid = fips.isin(pop_by_fips.index) & fips.isin(area_by_fips.index) & composed_key.notna()
+        attributes.append(make_attributes(
+            composed_key[is_valid].to_numpy(),
+            fips[is_valid].map(pop_by_fips).to_numpy(),
+            fips[is_valid].map(area_by_fips).to_numpy(),
+        ))
+
+    if len(attributes) == 0:
+        return make_attributes([], [], [])
+    return pd.concat(attributes, ignore_index=True)
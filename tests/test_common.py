@@ -0,0 +1,121 @@
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from percy.common import TIMELINE_COLUMNS, build_timeline
+
+
+def reference_build_timeline(df, date_column, cases_column, deaths_column, is_cumulative_sum=False):
+    # the row by row normalize_timeline build_timeline replaced
+    df = df.copy()
+    df[date_column] = pd.to_datetime(df[date_column])
+    df = df.sort_values(by=[date_column], ascending=[True])
+
+    if is_cumulative_sum:
+        df[cases_column] = df[cases_column].cumsum()
+        df[deaths_column] = df[deaths_column].cumsum()
+
+    df = df[df[cases_column] > 0]
+
+    prev_date = None
+    prev_cases = 0
+    prev_deaths = 0
+
+    timeline = []
+    for _, row in df.iterrows():
+        date = row[date_column]
+
+        if prev_date and (date - prev_date).days > 1:
+            missing_date = prev_date + timedelta(days=1)
+            while (date - missing_date).days >= 1:
+                timeline.append([missing_date, prev_cases, 0, prev_deaths, 0])
+                missing_date = missing_date + timedelta(days=1)
+
+        cases = row[cases_column]
+        cases_daily = max(0, cases - prev_cases)
+        deaths = row[deaths_column]
+        deaths_daily = max(0, deaths - prev_deaths)
+
+        timeline.append([date, cases, cases_daily, deaths, deaths_daily])
+
+        prev_cases = cases
+        prev_deaths = deaths
+        prev_date = date
+
+    return pd.DataFrame(timeline, columns=TIMELINE_COLUMNS)
+
+
+def assert_same_timeline(df, *args):
+    expected = reference_build_timeline(df, *args)
+    actual = build_timeline(df, *args)
+    assert len(actual) == len(expected)
+    if len(expected) == 0:
+        return
+    pd.testing.assert_series_equal(actual['date'], expected['date'], check_dtype=False, check_names=False)
+    for column in TIMELINE_COLUMNS[1:]:
+        np.testing.assert_allclose(actual[column].to_numpy(dtype=float), expected[column].to_numpy(dtype=float), equal_nan=True)
+
+
+def ecdc_frame(cases, deaths, dates=None):
+    # ECDC files list daily counts, newest first
+    if dates is None:
+        dates = pd.date_range('2020-03-01', periods=len(cases)).strftime('%Y-%m-%d')
+    return pd.DataFrame({'dateRep': dates, 'cases': cases, 'deaths': deaths}).iloc[::-1]
+
+
+def region_frame(cases, deaths, dates):
+    return pd.DataFrame({'date': dates, 'confirmed': cases, 'deaths': deaths})
+
+
+def test_ecdc_daily_counts_are_accumulated():
+    df = ecdc_frame([0, 0, 3, 5, 0, 2, 10], [0, 0, 0, 1, 0, 0, 2])
+    assert_same_timeline(df, 'dateRep', 'cases', 'deaths', True)
+
+
+def test_ecdc_negative_corrections():
+    df = ecdc_frame([4, 6, -3, 2, 0, -1, 5], [0, 1, -1, 0, 2, 0, 1])
+    assert_same_timeline(df, 'dateRep', 'cases', 'deaths', True)
+
+
+def test_cumulative_counts_with_gaps():
+    dates = ['2020-04-01', '2020-04-02', '2020-04-05', '2020-04-06', '2020-04-10']
+    df = region_frame([1, 3, 8, 8, 20], [0, 0, 1, 1, 2], dates)
+    assert_same_timeline(df, 'date', 'confirmed', 'deaths')
+
+
+def test_unsorted_dates_zero_and_negative_steps():
+    dates = ['2020-04-03', '2020-04-01', '2020-04-02', '2020-04-06', '2020-04-04']
+    df = region_frame([5, 2, 5, 4, 0], [1, 0, 2, 1, 0], dates)
+    assert_same_timeline(df, 'date', 'confirmed', 'deaths')
+
+
+def test_missing_values():
+    dates = ['2020-04-01', '2020-04-02', '2020-04-03', '2020-04-04', '2020-04-06', '2020-04-07']
+    df = region_frame([1, np.nan, 4, 6, 6, 9], [0, 1, np.nan, 2, np.nan, 3], dates)
+    assert_same_timeline(df, 'date', 'confirmed', 'deaths')
+
+
+def test_no_cases():
+    df = region_frame([0, 0], [0, 0], ['2020-04-01', '2020-04-02'])
+    assert_same_timeline(df, 'date', 'confirmed', 'deaths')
+    assert list(build_timeline(df, 'date', 'confirmed', 'deaths').columns) == TIMELINE_COLUMNS
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_random_timelines(seed):
+    rng = np.random.default_rng(seed)
+    days = int(rng.integers(1, 60))
+    dates = pd.date_range('2020-03-01', periods=days)
+    kept = rng.random(days) > 0.2
+    kept[0] = True
+    cases = np.cumsum(rng.integers(-2, 20, days)).astype(float)
+    deaths = np.cumsum(rng.integers(-1, 3, days)).astype(float)
+    cases[rng.random(days) < 0.05] = np.nan
+    deaths[rng.random(days) < 0.05] = np.nan
+    df = region_frame(cases[kept], deaths[kept], dates[kept].strftime('%Y-%m-%d'))
+    assert_same_timeline(df.sample(frac=1, random_state=seed), 'date', 'confirmed', 'deaths')
+
+    daily = ecdc_frame(rng.integers(-1, 30, days), rng.integers(0, 3, days), dates.strftime('%Y-%m-%d'))
+    assert_same_timeline(daily, 'dateRep', 'cases', 'deaths', True)
@@ -0,0 +1,71 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmarks.synthetic import generate
+from percy.clusters import DISTANCE_FEATURES, load_timelines, per_single_timeline, save_timelines
+from percy.compute import compute_region, create_compute_pool
+from percy.timelines import TimelineStore
+
+
+@pytest.fixture
+def regions(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    metadata = generate('inf-covid19-data', 60)
+
+    keys = []
+    for country, data in metadata.items():
+        keys += [country] + [f'{country}.regions.{region}' for region in data['regions']]
+    df = pd.DataFrame({
+        'key': keys,
+        'population': np.linspace(10 ** 4, 10 ** 7, len(keys)),
+        'cluster': np.arange(len(keys)) % 3,
+    })
+    return metadata, df
+
+
+def test_saved_timelines_follow_the_regions(regions, tmp_path):
+    metadata, df = regions
+    expected = TimelineStore()
+    load_timelines(metadata, df, expected)
+
+    # with a budget of a few regions, the timelines are saved chunk by chunk
+    directory = str(tmp_path / 'timelines')
+    os.makedirs(directory)
+    save_timelines(metadata, df, directory, TimelineStore(budget=50000))
+    result = TimelineStore.load(directory, mmap_mode='r')
+
+    assert list(result.keys()) == df['key'].tolist()
+    for key in df['key']:
+        pd.testing.assert_frame_equal(result.get(key), expected.get(key)[['date'] + DISTANCE_FEATURES])
+
+
+@pytest.mark.parametrize('top_k, metric', [(None, 'manhattan'), (5, 'manhattan'), (5, 'dtw')])
+def test_small_timeline_budget(regions, top_k, metric):
+    # with a budget of a few regions, the others are compared chunk by chunk
+    metadata, df = regions
+    expected_store = TimelineStore()
+    store = TimelineStore(budget=50000)
+
+    for key in df['key'][::25]:
+        expected = per_single_timeline(metadata, key, df, expected_store, top_k=top_k, metric=metric)
+        result = per_single_timeline(metadata, key, df, store, top_k=top_k, metric=metric)
+        pd.testing.assert_frame_equal(result, expected)
+        assert store.nbytes <= store.budget
+
+
+def test_compute_pool(regions):
+    metadata, df = regions
+    store = TimelineStore()
+    pool = create_compute_pool(metadata, df, processes=2, store=TimelineStore(budget=50000))
+    try:
+        for key in df['key'][::10]:
+            result, _, stats, _, _ = pool.apply(compute_region, (key,))
+            pd.testing.assert_frame_equal(result, per_single_timeline(metadata, key, df, store))
+            assert stats['regions'] == len(df)
+    finally:
+        pool.stop()
+
+    assert not os.path.exists(pool.directory)
@@ -0,0 +1,47 @@
+import os
+import subprocess
+
+from percy.freshness import FreshnessIndex
+
+
+def git(repo, *args, env=None):
+    command = ['git', '-C', str(repo), '-c', 'user.name=percy', '-c', 'user.email=percy@localhost', *args]
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL, env=dict(os.environ, **(env or {})))
+
+
+def commit(repo, filenames, timestamp):
+    for filename in filenames:
+        (repo / filename).write_text(str(timestamp))
+    git(repo, 'add', '--all')
+    git(repo, 'commit', '-q', '-m', str(timestamp), env={'GIT_COMMITTER_DATE': f'@{timestamp} +0000', 'GIT_AUTHOR_DATE': f'@{timestamp} +0000'})
+
+
+def test_non_ascii_paths(tmp_path):
+    git(tmp_path, 'init', '-q')
+    commit(tmp_path, ['São Paulo.csv', 'Brasília.csv', 'b.csv'], 1600000000)
+    commit(tmp_path, ['São Paulo.csv'], 1600086400)
+
+    index = FreshnessIndex(str(tmp_path))
+    index.build()
+
+    assert index.timestamps == {'São Paulo.csv': 1600086400, 'Brasília.csv': 1600000000, 'b.csv': 1600000000}
+
+
+def test_touch_outlives_older_commits(tmp_path):
+    git(tmp_path, 'init', '-q')
+    commit(tmp_path, ['a.csv'], 1600000000)
+
+    index = FreshnessIndex(str(tmp_path))
+    index.touch('a.csv', 1600172800)
+    index.touch('new.csv', 1600172800)
+    index.build()
+
+    assert index.get('a.csv') == 1600172800
+    assert index.get('new.csv') == 1600172800
+
+
+def test_missing_repository(tmp_path):
+    index = FreshnessIndex(str(tmp_path / 'missing'))
+    index.build()
+
+    assert index.get('a.csv') == 0
@@ -0,0 +1,55 @@
+import os
+
+from percy import neighbors as neighbors_module
+from percy.neighbors import NeighborIndex
+
+
+def test_affected_regions(tmp_path):
+    index = NeighborIndex(str(tmp_path))
+    index.update({'a': ['b', 'c'], 'b': ['a'], 'c': ['d'], 'd': ['c'], 'e': []})
+
+    # b lists a, and a lists b and c
+    assert index.get_affected(['a']) == {'a', 'b', 'c'}
+    assert index.get_affected(['d']) == {'c', 'd'}
+    # f has no output yet
+    assert index.get_affected(['f']) == {'f'}
+    assert index.get_affected([]) == set()
+
+
+def test_updates_replace_outputs(tmp_path):
+    index = NeighborIndex(str(tmp_path))
+    index.update({'a': ['b'], 'c': ['b']})
+    index.update({'a': ['c']})
+
+    assert index.get_affected(['b']) == {'b', 'c'}
+    assert index.get_affected(['c']) == {'a', 'b', 'c'}
+
+
+def test_shared_between_instances(tmp_path):
+    # e.g. the server and a similarity.py run on the same cache
+    first = NeighborIndex(str(tmp_path))
+    second = NeighborIndex(str(tmp_path))
+
+    first.update({'a': ['b']})
+    second.update({'c': ['a'], 'b': ['c']})
+    first.update({'b': []})
+
+    assert first.get_affected(['a']) == {'a', 'b', 'c'}
+    assert second.get_affected(['c']) == {'a', 'c'}
+    assert NeighborIndex(str(tmp_path)).get_affected(['a']) == {'a', 'b', 'c'}
+
+
+def test_compaction(tmp_path, monkeypatch):
+    monkeypatch.setattr(neighbors_module, 'MIN_COMPACT_BYTES', 0)
+    index = NeighborIndex(str(tmp_path))
+    other = NeighborIndex(str(tmp_path))
+    other.update({'z': ['a']})
+
+    for idx in range(20):
+        index.update({'a': [f'n{idx}', 'b']})
+
+    # a single record per region is left
+    assert os.path.getsize(tmp_path / 'log.bin') <= 2 * (8 + 4 * 2 + 8 + 4 * 1)
+    assert index.get_affected(['b']) == {'a', 'b'}
+    assert other.get_affected(['a']) == {'a', 'b', 'n19', 'z'}
+    assert NeighborIndex(str(tmp_path)).get_affected(['n19']) == {'a', 'n19'}
@@ -0,0 +1,59 @@
+import gzip
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from percy.payloads import Payload
+from percy.storage import ARROW_STREAM_MEDIA_TYPE, CSV_MEDIA_TYPE, PARQUET_MEDIA_TYPE, get_media_types
+
+
+@pytest.fixture
+def df():
+    return pd.DataFrame({
+        'region': ['Brazil', 'Brazil:Sao Paulo', None],
+        'distance': [0.0, 1.5, np.nan],
+        'is_same_cluster': [True, False, True],
+    })
+
+
+def test_csv_payload(df):
+    payload = Payload.from_frame(df)
+
+    assert payload.content_type == 'text/plain; charset=UTF-8'
+    assert payload.body == df.to_csv(index=False).encode('utf-8')
+    assert payload.encode('gzip') == ('gzip', payload.encodings['gzip'])
+    assert payload.encode('') == ('identity', payload.body)
+
+
+def test_brotli_encoding(df):
+    brotli = pytest.importorskip('brotli')
+    payload = Payload.from_frame(df)
+
+    encoding, body = payload.encode('gzip, br')
+    assert encoding == 'br'
+    assert brotli.decompress(body) == payload.body
+    assert payload.encode('br;q=0, gzip')[0] == 'gzip'
+
+
+def test_arrow_payload(df):
+    pa = pytest.importorskip('pyarrow')
+    assert get_media_types() == [CSV_MEDIA_TYPE, ARROW_STREAM_MEDIA_TYPE, PARQUET_MEDIA_TYPE]
+
+    payload = Payload.from_frame(df, ARROW_STREAM_MEDIA_TYPE)
+    assert payload.content_type == ARROW_STREAM_MEDIA_TYPE
+    assert payload.etag != Payload.from_frame(df).etag
+
+    encoding, body = payload.encode('gzip, deflate')
+    assert encoding == 'gzip'
+    result = pa.ipc.open_stream(gzip.decompress(body)).read_pandas()
+    pd.testing.assert_frame_equal(result, df)
+
+
+def test_parquet_payload(df):
+    pytest.importorskip('pyarrow')
+
+    payload = Payload.from_frame(df, PARQUET_MEDIA_TYPE)
+    assert payload.content_type == PARQUET_MEDIA_TYPE
+    pd.testing.assert_frame_equal(pd.read_parquet(io.BytesIO(payload.body)), df)
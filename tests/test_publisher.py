@@ -0,0 +1,170 @@
+import os
+import subprocess
+import threading as th
+
+import pytest
+
+from percy.metrics import metrics
+from percy.publisher import Publisher
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'commit-and-push.sh')
+
+
+class Command(object):
+    # a publisher command that blocks until released and fails `failures`
+    # times before succeeding
+    def __init__(self, failures=0, blocked=False):
+        self.failures = failures
+        self.calls = 0
+        self.started = th.Event()
+        self.released = th.Event()
+        if not blocked:
+            self.released.set()
+
+    def __call__(self):
+        self.calls += 1
+        self.started.set()
+        self.released.wait()
+        if self.failures > 0:
+            self.failures -= 1
+            raise RuntimeError('push rejected')
+
+
+def get_counter(name):
+    return sum(value for (counter, _), value in metrics.counters.items() if counter == name)
+
+
+@pytest.fixture(autouse=True)
+def reset_metrics():
+    metrics.drain()
+    yield
+    metrics.drain()
+
+
+def test_publishes_full_batches():
+    command = Command()
+    publisher = Publisher(command, batch_size=3, max_delay=60)
+
+    # pending together before the publisher thread wakes up
+    with publisher.condition:
+        for idx in range(7):
+            publisher.publish(f'by_key/{idx}.csv')
+
+    assert command.started.wait(5)
+    assert publisher.flush(5)
+    assert command.calls == 1
+    assert get_counter('percy_published_outputs_total') == 7
+
+
+def test_waits_for_a_full_batch_or_the_delay():
+    command = Command()
+    publisher = Publisher(command, batch_size=3, max_delay=0.2)
+
+    publisher.publish('by_key/a.csv')
+    publisher.publish('by_key/b.csv')
+    assert not command.started.wait(0.05)
+
+    assert command.started.wait(5)
+    assert publisher.flush(5)
+    assert command.calls == 1
+    assert get_counter('percy_published_outputs_total') == 2
+
+
+def test_coalesces_outputs():
+    command = Command(blocked=True)
+    publisher = Publisher(command, batch_size=1, max_delay=60)
+
+    publisher.publish('by_key/a.csv')
+    assert command.started.wait(5)
+    assert publisher.lock.locked()
+
+    # written again while the first batch is being pushed
+    for _ in range(10):
+        publisher.publish('by_key/a.csv')
+        publisher.publish('by_key/b.csv')
+    assert publisher.stats() == {'pending': 2, 'publishing': True}
+
+    command.released.set()
+    assert publisher.flush(5)
+    assert command.calls == 2
+    assert get_counter('percy_published_outputs_total') == 3
+
+
+def test_backpressure():
+    command = Command(blocked=True)
+    publisher = Publisher(command, batch_size=1, max_delay=60, backlog=2)
+
+    publisher.publish('by_key/a.csv')
+    assert command.started.wait(5)
+    publisher.publish('by_key/b.csv')
+    publisher.publish('by_key/c.csv')
+
+    blocked = th.Thread(target=publisher.publish, args=('by_key/d.csv',), daemon=True)
+    blocked.start()
+    blocked.join(0.2)
+    assert blocked.is_alive()
+
+    command.released.set()
+    blocked.join(5)
+    assert not blocked.is_alive()
+    assert publisher.flush(5)
+    assert get_counter('percy_publish_backpressure_total') == 1
+    assert get_counter('percy_published_outputs_total') == 4
+
+
+def test_retries_failed_batches():
+    command = Command(failures=1)
+    publisher = Publisher(command, batch_size=50, max_delay=0.1)
+
+    publisher.publish('by_key/a.csv')
+    publisher.publish('by_key/b.csv')
+    assert publisher.flush(10)
+
+    assert command.calls == 2
+    assert get_counter('percy_publish_failures_total') == 1
+    assert get_counter('percy_published_outputs_total') == 2
+
+
+def git(*args, cwd=None):
+    command = ['git', '-c', 'user.name=percy', '-c', 'user.email=percy@localhost', *args]
+    return subprocess.run(command, cwd=cwd, check=True, stdout=subprocess.PIPE).stdout.decode()
+
+
+@pytest.fixture
+def repository(tmp_path, monkeypatch):
+    # a clone of a bare remote, laid out as commit-and-push.sh expects
+    remote = tmp_path / 'remote.git'
+    workdir = tmp_path / 'work'
+    clone = workdir / 'inf-covid19-similarity-data'
+
+    git('init', '-q', '--bare', str(remote))
+    git('init', '-q', str(clone))
+    (clone / 'regions.csv').write_text('key\n')
+    git('add', '--all', cwd=clone)
+    git('commit', '-q', '-m', 'initial', cwd=clone)
+    git('push', '-q', str(remote), 'HEAD:master', cwd=clone)
+
+    monkeypatch.setenv('SIMILARITY_REMOTE', str(remote))
+    return workdir, clone, remote
+
+
+def test_pushes_once_per_batch(repository):
+    workdir, clone, remote = repository
+
+    def commit_and_push():
+        subprocess.run(['bash', SCRIPT], cwd=workdir, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    publisher = Publisher(commit_and_push, batch_size=4, max_delay=60)
+    (clone / 'by_key').mkdir()
+    for batch in range(2):
+        for idx in range(4):
+            name = os.path.join('by_key', f'{batch}-{idx}.csv')
+            (clone / name).write_text('region\n')
+            publisher.publish(name)
+        assert publisher.flush(10)
+
+    # the initial commit and one per batch
+    assert git('--git-dir', str(remote), 'rev-list', '--count', 'master').strip() == '3'
+    files = git('--git-dir', str(remote), 'ls-tree', '-r', '--name-only', 'master').split()
+    assert sorted(files) == sorted(['regions.csv'] + [f'by_key/{batch}-{idx}.csv' for batch in range(2) for idx in range(4)])
+    assert get_counter('percy_published_outputs_total') == 8
@@ -0,0 +1,42 @@
+import os
+import subprocess
+import sys
+
+import pandas as pd
+
+from benchmarks.synthetic import generate
+from percy.neighbors import NeighborIndex
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_similarity(directory, **env):
+    os.makedirs(os.path.join(directory, 'inf-covid19-similarity-data'))
+    os.symlink(os.path.join(ROOT, 'raw'), os.path.join(directory, 'raw'))
+    generate(os.path.join(directory, 'inf-covid19-data'), 60)
+
+    env = dict(os.environ, PYTHONPATH=ROOT, SIMILARITY_METRIC='manhattan', SIMILARITY_PROCESSES='1', **env)
+    subprocess.run([sys.executable, '-m', 'percy.similarity'], cwd=directory, env=env, check=True, stdout=subprocess.DEVNULL)
+    return os.path.join(directory, 'inf-covid19-similarity-data')
+
+
+def read_output(filename):
+    # pairs come back from the block workers in any order
+    return pd.read_csv(filename).sort_values('region').reset_index(drop=True)
+
+
+def test_small_timeline_budget(tmp_path):
+    # with a budget far below the whole set, timelines are evicted between
+    # the all-pairs run and the watermarks
+    expected = run_similarity(str(tmp_path / 'unbounded'))
+    result = run_similarity(str(tmp_path / 'bounded'), TIMELINE_CACHE_BYTES='50000')
+
+    regions = pd.read_csv(os.path.join(expected, 'regions.csv'))['key']
+    assert sorted(os.listdir(os.path.join(result, 'by_key'))) == sorted(f'{key}.csv' for key in regions)
+
+    index = NeighborIndex(str(tmp_path / 'bounded' / 'cache' / 'neighbors'))
+    assert index.get_affected([regions[0]]) > {regions[0]}
+
+    pd.testing.assert_frame_equal(pd.read_csv(os.path.join(result, 'watermarks.csv')), pd.read_csv(os.path.join(expected, 'watermarks.csv')))
+    for key in regions:
+        pd.testing.assert_frame_equal(read_output(os.path.join(result, 'by_key', f'{key}.csv')), read_output(os.path.join(expected, 'by_key', f'{key}.csv')))
@@ -0,0 +1,72 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from percy.storage import EXTENSIONS, pq, read_frame, write_binary_frame, write_frame
+
+FORMATS = ['npz'] + (['parquet'] if pq is not None else [])
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('SIMILARITY_CACHE_DIR', 'cache')
+    os.makedirs(os.path.join('inf-covid19-similarity-data', 'by_key'))
+    return tmp_path
+
+
+@pytest.mark.parametrize('storage_format', FORMATS)
+def test_round_trip_keeps_missing_values(workdir, monkeypatch, storage_format):
+    monkeypatch.setenv('SIMILARITY_STORAGE_FORMAT', storage_format)
+    df = pd.DataFrame({
+        'region': ['a', None, 'None', 'nan', np.nan],
+        'distance': [0.5, np.nan, 1.0, 2.0, 3.0],
+        'is_same_cluster': [True, False, True, False, True],
+    })
+
+    # read from the binary copy alone
+    filename = os.path.join('inf-covid19-similarity-data', 'by_key', 'region')
+    write_binary_frame(df, filename)
+    result = read_frame(filename)
+
+    assert result['region'].isna().tolist() == [False, True, False, False, True]
+    assert result['region'].tolist()[2:4] == ['None', 'nan']
+    assert result['distance'].isna().tolist() == [False, True, False, False, False]
+    assert result['is_same_cluster'].tolist() == [True, False, True, False, True]
+
+
+@pytest.mark.parametrize('storage_format', FORMATS)
+def test_binary_copies_are_made_on_read(workdir, monkeypatch, storage_format):
+    monkeypatch.setenv('SIMILARITY_STORAGE_FORMAT', storage_format)
+    filename = os.path.join('inf-covid19-similarity-data', 'by_key', 'region')
+    binary_filename = os.path.join('cache', 'frames', f'{filename}{EXTENSIONS[storage_format]}')
+    df = pd.DataFrame({'region': ['a', 'b'], 'distance': [0.5, np.nan]})
+
+    write_frame(df, filename)
+    assert not os.path.exists(binary_filename)
+
+    expected = read_frame(filename)
+    assert os.path.isfile(binary_filename)
+    # and never published
+    assert os.listdir(os.path.join('inf-covid19-similarity-data', 'by_key')) == ['region.csv']
+
+    os.remove(f'{filename}.csv')
+    pd.testing.assert_frame_equal(read_frame(filename), expected)
+
+
+def test_newer_csv_wins(workdir, monkeypatch):
+    monkeypatch.setenv('SIMILARITY_STORAGE_FORMAT', 'npz')
+    filename = os.path.join('inf-covid19-similarity-data', 'regions')
+    write_frame(pd.DataFrame({'key': ['a']}), filename)
+    assert read_frame(filename)['key'].tolist() == ['a']
+
+    write_frame(pd.DataFrame({'key': ['b']}), filename)
+    binary_filename = os.path.join('cache', 'frames', f'{filename}.npz')
+    os.utime(binary_filename, (0, 0))
+
+    assert read_frame(filename)['key'].tolist() == ['b']
+    # the copy is made again from the newer CSV
+    os.remove(f'{filename}.csv')
+    assert read_frame(filename)['key'].tolist() == ['b']
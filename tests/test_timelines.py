@@ -0,0 +1,37 @@
+import numpy as np
+import pandas as pd
+
+from percy.timelines import TimelineStore
+
+
+def get_timeline(start, days, value):
+    return pd.DataFrame({
+        'date': pd.date_range(start, periods=days),
+        'cases': np.arange(days) + value,
+        'deaths': np.zeros(days) + value,
+    })
+
+
+def test_concat(tmp_path):
+    stores = [TimelineStore(features=['cases', 'deaths']) for _ in range(3)]
+    stores[0].update({'a': get_timeline('2020-03-01', 10, 1), 'b': pd.DataFrame()})
+    stores[1].update({'c': get_timeline('2020-02-20', 5, 2)})
+    stores[2].update({'d': get_timeline('2020-03-05', 20, 3), 'e': get_timeline('2020-03-06', 2, 4)})
+    stores[2].discard(['e'])
+
+    directories = []
+    for idx, store in enumerate(stores):
+        directory = tmp_path / str(idx)
+        directory.mkdir()
+        store.save(str(directory))
+        directories.append(str(directory))
+
+    (tmp_path / 'all').mkdir()
+    TimelineStore.concat(directories, str(tmp_path / 'all'), ['d', 'c', 'b', 'a'])
+    result = TimelineStore.load(str(tmp_path / 'all'), mmap_mode='r')
+
+    assert list(result.keys()) == ['d', 'c', 'b', 'a']
+    assert result.origin == np.datetime64('2020-02-20')
+    assert result.values.shape == (4, 34, 2)
+    for key, store in zip(['a', 'b', 'c', 'd'], [stores[0], stores[0], stores[1], stores[2]]):
+        pd.testing.assert_frame_equal(result.get(key), store.get(key))